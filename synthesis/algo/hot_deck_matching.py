@@ -1,8 +1,13 @@
-import itertools, functools
 import multiprocessing as mp
+import multiprocessing.shared_memory
+import copy
+import hashlib
+import pickle
+import os
+import time
 from tqdm import tqdm
-from re import search
 import numpy as np
+import pandas as pd
 
 '''
 Random hot-deck imputation
@@ -10,6 +15,12 @@ Random hot-deck imputation
 A statistical matching method according to the Sao Paulo synthetic population.
 https://github.com/eqasim-org/sao_paulo
 
+Every combination of attribute values is a cell. The attributes are integer-encoded
+and combined into mixed-radix cell keys, the source rows are grouped by cell once and
+every target looks up its cell with a binary search. Preferred attributes may be
+relaxed (replaced by an "any" digit) if the cell has too few source samples; the
+relaxation levels are tried in the same order as the former cartesian search order.
+
 '''
 
 class HotDeckMatcher:
@@ -18,7 +29,7 @@ class HotDeckMatcher:
         self.preferred_attributes = preferred_attributes
         self.all_attributes = self.mandatory_attributes + self.preferred_attributes
         self.minimum_samples = matching_minimum_samples
-        self.source_ids = df_source[source_id_column]
+        self.source_ids = df_source[source_id_column].values
         self.default_id = default_id
 
         #get list of unique values for each attribute
@@ -27,88 +38,316 @@ class HotDeckMatcher:
         }
 
         self.attribute_values_count = [len(self.unique_values[col]) for col in self.all_attributes]
-        self.attribute_indices = np.cumsum(self.attribute_values_count)
+        self.code_dtype = np.min_scalar_type(-max(self.attribute_values_count + [1])) # signed, -1 marks unknown values
 
         for attrib in self.all_attributes:
             print("Found categories for %s:" % attrib, ", ".join([str(c) for c in self.unique_values[attrib]]))
 
-        #define search order for each column with unique value
-        search_order = [
-            [list(np.arange(size) == k) for k in range(size)] +
-            ([] if attrib in self.mandatory_attributes else [[False] * size])
+        #mixed-radix digits, preferred attributes have an extra "any" digit (the last one)
+        self.radices = np.array([
+            size + (0 if attrib in self.mandatory_attributes else 1)
             for attrib, size in zip(self.all_attributes, self.attribute_values_count)
-        ]
+        ], dtype = np.int64)
+
+        if np.prod(self.radices.astype(float)) >= np.iinfo(np.int64).max:
+            raise RuntimeError("Too many attribute combinations to encode the matching cells")
+
+        self.strides = np.ones(len(self.radices), dtype = np.int64)
+        self.strides[:-1] = np.cumprod(self.radices[::-1])[::-1][1:]
 
-        #cartesian product of column search order
-        self.attribute_masks = list(itertools.product(*search_order)) 
+        #cells of a stratum (combination of mandatory values) form a contiguous key range
+        mandatory_count = len(self.mandatory_attributes)
+        self.stratum_width = self.strides[mandatory_count - 1] if mandatory_count > 0 else np.prod(self.radices)
 
-        #source filter mask
-        self.source_matrix = self.make_matrix(df_source, source = True)
+        #relaxation levels are bit masks of relaxed preferred attributes (first preferred attribute is the most significant bit)
+        self.levels_count = 2 ** len(self.preferred_attributes)
+
+        #source index: cell key -> source row indices
+        start_time = time.time()
+        source_matrix = self.make_matrix(df_source, source = True)
+        self.timings = dict(source_encoding = time.time() - start_time)
+
+        start_time = time.time()
+        self.make_index(source_matrix)
+        self.timings["indexing"] = time.time() - start_time
 
     def __call__(self, df_target, chunk_index = 0):
-        target_matrix = self.make_matrix(df_target)
-        matched_mask = np.zeros(len(df_target), dtype=bool)
-        matched_indices = np.ones(len(df_target), dtype=int) * (-1)
+        return self.make_ids(self.match_frame(df_target, chunk_index)[0])
+
+    '''
+    Returns the matched source rows and the relaxation levels of the data frame rows.
+    '''
+    def match_frame(self, df_target, chunk_index = 0):
+        target_matrix = self.make_matrix(df_target, chunk_index)
 
         # Note: This speeds things up quite a bit. We generate a random number
         # for each person which is later on used for the sampling.
-        random = np.array([
-            np.random.random() for _ in tqdm(range(len(df_target)), desc = "Generating random numbers", position = chunk_index)
-        ])
+        random = np.random.random(len(df_target))
 
-        with tqdm(total = len(self.attribute_masks), position = chunk_index, desc = "Hot Deck Matching") as progress:
-            for attrib_mask in self.attribute_masks:
-                attrib_mask = np.array(functools.reduce(lambda x, y: x + y, attrib_mask), dtype = np.bool)
-                source_mask = np.all(self.source_matrix[:, attrib_mask], axis = 1) #the whole row has "True" for columns specified in attrib_mask
+        return self.match_matrix(target_matrix, random, chunk_index)
+
+    '''
+    Matches a small batch of records (data frame or dict of columns) against the index, without progress output.
+    The random_state may be a np.random.RandomState or a np.random.Generator.
+    '''
+    def match(self, records, random_state = None):
+        df_records = records if isinstance(records, pd.DataFrame) else pd.DataFrame(records)
+        random = (np.random if random_state is None else random_state).random(len(df_records))
 
-                if np.any(source_mask) and np.count_nonzero(source_mask) >= self.minimum_samples: # match these with target
-                    target_mask = np.all(target_matrix[:, attrib_mask], axis = 1) 
+        target_matrix = self.make_matrix(df_records, verbose = False)
+        return self.make_ids(self.match_matrix(target_matrix, random, verbose = False)[0])
 
-                    if np.any(target_mask):
-                        source_indices = np.where(source_mask)[0] #array of indices where source_mask is True
-                        random_indices = np.floor(random[target_mask] * len(source_indices)).astype(np.int) #scaled random indices to the length of source_indices
-                        matched_indices[np.where(~matched_mask)[0][target_mask]] = source_indices[random_indices] #assign a random index from the matched source samples
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol = pickle.HIGHEST_PROTOCOL)
 
-                        # We continuously shrink these matrix to make the matching
-                        # easier and easier as the HDM proceeds
-                        random = random[~target_mask]
-                        target_matrix = target_matrix[~target_mask] # keep not yet matched
-                        matched_mask[~matched_mask] |= target_mask
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
 
-                progress.update()
+    def make_ids(self, matched_indices):
+        matched_mask = matched_indices >= 0
 
-        matched_ids = np.zeros(len(df_target), dtype = self.source_ids.dtype)
-        matched_ids[matched_mask] = self.source_ids.iloc[matched_indices[matched_mask]]
+        matched_ids = np.zeros(len(matched_indices), dtype = self.source_ids.dtype)
+        matched_ids[matched_mask] = self.source_ids[matched_indices[matched_mask]]
         matched_ids[~matched_mask] = self.default_id
 
         return matched_ids
 
     '''
-    Expands dataframe into a matrix with type of columns with their unique value, mark T/F for if the value matches.
+    Encodes dataframe into a matrix of attribute codes (index into the unique values of the attribute, -1 if unknown).
+    The codes are stored in the smallest signed integer type, i.e. one byte per attribute for the usual categories.
     '''
-    def make_matrix(self, df, chunk_index = None, source = False):
-        columns = sum(self.attribute_values_count)
+    def make_matrix(self, df, chunk_index = None, source = False, verbose = True):
+        matrix = np.zeros((len(df), len(self.all_attributes)), dtype = self.code_dtype)
 
-        matrix = np.zeros((len(df), columns), dtype = np.bool)
-        column_index = 0
-
-        with tqdm(total = columns, desc = "Reading categories (%s) ..." % ("source" if source else "target"), position = chunk_index) as progress:
-            for attribute in self.all_attributes:
-                for value in self.unique_values[attribute]:
-                    matrix[:, column_index] = df[attribute] == value
-                    column_index += 1
-                    progress.update()
+        with tqdm(total = len(self.all_attributes), desc = "Reading categories (%s) ..." % ("source" if source else "target"), position = chunk_index, disable = not verbose) as progress:
+            for column_index, attribute in enumerate(self.all_attributes):
+                values = df[attribute]
+                matrix[:, column_index] = pd.Index(self.unique_values[attribute]).get_indexer(values)
+                matrix[values.isna().values, column_index] = -1 # missing values never match
+                progress.update()
         return matrix
 
-def run(df_target, df_source, source_id_column, mandatory_fields, preferred_fields, default_id = -1, minimum_source_samples = 1, process_num = 1):
+    '''
+    Cell keys of the matrix rows for a relaxation level, rows with an unknown value in a non-relaxed attribute are not valid.
+    '''
+    def make_keys(self, matrix, level):
+        keys = np.zeros(len(matrix), dtype = np.int64)
+        valid = np.ones(len(matrix), dtype = bool)
+
+        for column_index, attribute in enumerate(self.all_attributes):
+            if self.is_relaxed(attribute, level):
+                keys += (self.radices[column_index] - 1) * self.strides[column_index]
+            else:
+                codes = matrix[:, column_index]
+                valid &= codes >= 0
+                keys += codes.astype(np.int64) * self.strides[column_index]
+
+        return keys, valid
+
+    def is_relaxed(self, attribute, level):
+        if attribute in self.mandatory_attributes:
+            return False
+
+        bit = len(self.preferred_attributes) - 1 - self.preferred_attributes.index(attribute)
+        return bool(level & (1 << bit))
+
+    '''
+    Stratum keys (first cell key of the stratum) of the matrix rows, -1 if a mandatory value is unknown.
+    '''
+    def make_strata(self, matrix):
+        strata = np.zeros(len(matrix), dtype = np.int64)
+        valid = np.ones(len(matrix), dtype = bool)
+
+        for column_index, attribute in enumerate(self.mandatory_attributes):
+            codes = matrix[:, column_index]
+            valid &= codes >= 0
+            strata += codes.astype(np.int64) * self.strides[column_index]
+
+        strata[~valid] = -1
+        return strata
+
+    '''
+    Returns a copy of the matcher which only holds the source cells of the given strata.
+    '''
+    def select_strata(self, strata):
+        cells = [
+            np.arange(*np.searchsorted(self.cell_keys, [stratum, stratum + self.stratum_width]))
+            for stratum in strata if stratum >= 0
+        ]
+        cells = np.concatenate(cells) if len(cells) > 0 else np.zeros(0, dtype = np.int64)
+
+        selected = copy.copy(self)
+        selected.cell_keys = self.cell_keys[cells]
+        selected.cell_counts = self.cell_counts[cells]
+        selected.cell_starts = (np.cumsum(selected.cell_counts) - selected.cell_counts).astype(self.cell_starts.dtype)
+        selected.cell_indices = np.concatenate([self.cell_indices[:0]] + [
+            self.cell_indices[start:start + count] for start, count in zip(self.cell_starts[cells].astype(np.int64), self.cell_counts[cells].astype(np.int64))
+        ])
+
+        return selected
+
+    '''
+    Groups source rows by cell for all relaxation levels (CSR layout), cells with too few samples are left out.
+    '''
+    def make_index(self, source_matrix):
+        keys, rows = [], []
+
+        for level in range(self.levels_count):
+            level_keys, valid = self.make_keys(source_matrix, level)
+            keys.append(level_keys[valid])
+            rows.append(np.where(valid)[0])
+
+        keys, rows = np.concatenate(keys), np.concatenate(rows)
+        sorter = np.argsort(keys, kind = "stable") # source rows stay ordered within a cell
+        keys, rows = keys[sorter], rows[sorter]
+
+        cell_keys, cell_starts, cell_counts = np.unique(keys, return_index = True, return_counts = True)
+        f = cell_counts >= max(self.minimum_samples, 1)
+
+        index_dtype = np.min_scalar_type(len(rows))
+
+        self.cell_keys = cell_keys[f]
+        self.cell_starts = cell_starts[f].astype(index_dtype)
+        self.cell_counts = cell_counts[f].astype(index_dtype)
+        self.cell_indices = rows.astype(np.min_scalar_type(len(source_matrix)))
+
+    '''
+    Returns the matched source row for each target row and the relaxation level it was matched on (-1 if not matched).
+    '''
+    def match_matrix(self, target_matrix, random, chunk_index = 0, verbose = True):
+        matched_indices = np.ones(len(target_matrix), dtype = np.int64) * (-1)
+        matched_levels = np.ones(len(target_matrix), dtype = np.int8) * (-1)
+        pending = np.arange(len(target_matrix))
+
+        with tqdm(total = self.levels_count, position = chunk_index, desc = "Hot Deck Matching", disable = not verbose) as progress:
+            for level in range(self.levels_count):
+                if len(pending) > 0 and len(self.cell_keys) > 0:
+                    keys, valid = self.make_keys(target_matrix[pending], level)
+
+                    cells = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+                    found = valid & (self.cell_keys[cells] == keys)
+                    cells = cells[found]
+
+                    random_indices = np.floor(random[pending[found]] * self.cell_counts[cells]).astype(np.int64)
+                    matched_indices[pending[found]] = self.cell_indices[self.cell_starts[cells].astype(np.int64) + random_indices]
+                    matched_levels[pending[found]] = level
+                    pending = pending[~found]
+
+                progress.update()
+
+        return matched_indices, matched_levels
+
+    '''
+    Source pool size and number of matched targets for each cell that was used in the matching.
+    '''
+    def make_cell_statistics(self, target_matrix, matched_levels):
+        df_cells = []
+
+        for level in range(self.levels_count):
+            f = matched_levels == level
+
+            if np.any(f):
+                keys, counts = np.unique(self.make_keys(target_matrix[f], level)[0], return_counts = True)
+                cells = np.searchsorted(self.cell_keys, keys)
+
+                df_level = pd.DataFrame(dict(level = level, pool_size = self.cell_counts[cells], targets = counts))
+
+                for column_index, attribute in enumerate(self.all_attributes):
+                    codes = (keys // self.strides[column_index]) % self.radices[column_index]
+                    df_level[attribute] = [
+                        "*" if code == self.attribute_values_count[column_index] else self.unique_values[attribute][code]
+                        for code in codes
+                    ]
+
+                df_cells.append(df_level)
+
+        if len(df_cells) == 0:
+            return pd.DataFrame(columns = ["level", "pool_size", "targets"] + self.all_attributes)
+
+        df_cells = pd.concat(df_cells, ignore_index = True)
+        return df_cells[["level", "pool_size", "targets"] + self.all_attributes]
+
+# Increase whenever the layout of the pickled HotDeckMatcher changes, older cached indices are then rebuilt
+INDEX_FORMAT_VERSION = 1
+
+'''
+Returns a hash of the source data, of the matching settings and of the index format, used as the key of the cached index.
+'''
+def source_hash(df_source, source_id_column, mandatory_fields, preferred_fields, default_id, minimum_source_samples):
+    columns = [source_id_column] + mandatory_fields + preferred_fields
+
+    digest = hashlib.md5()
+    digest.update(("hdm_index_v%d" % INDEX_FORMAT_VERSION).encode())
+    digest.update(pd.util.hash_pandas_object(df_source[columns], index = False).values.tobytes())
+    digest.update(repr((columns, len(mandatory_fields), default_id, minimum_source_samples)).encode())
+
+    return digest.hexdigest()
+
+'''
+Loads the compiled matcher from the cache directory, or builds and stores it if the source has changed.
+'''
+def load_or_build(df_source, source_id_column, mandatory_fields, preferred_fields, default_id = -1, minimum_source_samples = 1, cache_path = None):
+    if cache_path is None:
+        return HotDeckMatcher(df_source, source_id_column, mandatory_fields, preferred_fields, default_id, minimum_source_samples)
+
+    path = os.path.join(cache_path, "hdm_index_%s.p" % source_hash(
+        df_source, source_id_column, mandatory_fields, preferred_fields, default_id, minimum_source_samples
+    ))
+
+    if os.path.exists(path):
+        print("Loading hot deck matching index:", path)
+        matcher = HotDeckMatcher.load(path)
+        matcher.timings = dict(source_encoding = 0.0, indexing = 0.0) # nothing has been built in this run
+        return matcher
+
     matcher = HotDeckMatcher(df_source, source_id_column, mandatory_fields, preferred_fields, default_id, minimum_source_samples)
-    if process_num > 1:
-        
+
+    os.makedirs(cache_path, exist_ok = True)
+    matcher.save(path)
+    print("Saved hot deck matching index:", path)
+
+    return matcher
+
+'''
+Matches the census on the source and writes the "hdm_source_id" and "hdm_relaxation_level" columns. The relaxation
+level is the bit mask of dropped preferred attributes (first preferred attribute is the most significant bit), -1
+for unmatched persons. Returns the wall times per phase and the statistics of the used cells.
+'''
+def run(df_target, df_source, source_id_column, mandatory_fields, preferred_fields, default_id = -1, minimum_source_samples = 1, process_num = 1, use_shared_memory = False, partition = "rows", cache_path = None):
+    start_time = time.time()
+    matcher = load_or_build(df_source, source_id_column, mandatory_fields, preferred_fields, default_id, minimum_source_samples, cache_path)
+    timings = dict(matcher.timings, matcher_setup = time.time() - start_time)
+
+    start_time = time.time()
+    target_matrix = matcher.make_matrix(df_target)
+    timings["target_encoding"] = time.time() - start_time
+
+    start_time = time.time()
+    if process_num > 1 and use_shared_memory:
+        matched_indices, matched_levels = run_shared(matcher, target_matrix, np.random.random(len(df_target)), process_num, partition)
+
+    elif process_num > 1 and partition == "strata":
+        matched_indices, matched_levels = run_strata(matcher, target_matrix, np.random.random(len(df_target)), process_num)
+
+    elif process_num > 1:
+        # the workers encode their chunks themselves, so the sampling time includes a second encoding
         with mp.Pool(processes = process_num, initializer = initializer, initargs = (matcher,)) as pool:
             chunks = np.array_split(df_target, process_num)
-            df_target.loc[:, "hdm_source_id"] = np.hstack(pool.map(running_process, enumerate(chunks)))
+            results = pool.map(running_process, enumerate(chunks))
+            matched_indices = np.hstack([result[0] for result in results])
+            matched_levels = np.hstack([result[1] for result in results])
     else:
-        df_target.loc[:, "hdm_source_id"] = matcher(df_target, 0)
+        matched_indices, matched_levels = matcher.match_matrix(target_matrix, np.random.random(len(df_target)))
+
+    timings["sampling"] = time.time() - start_time
+
+    df_target.loc[:, "hdm_source_id"] = matcher.make_ids(matched_indices)
+    df_target.loc[:, "hdm_relaxation_level"] = matched_levels
+
+    return dict(timings = timings, cells = matcher.make_cell_statistics(target_matrix, matched_levels))
 
 matcher = None
 
@@ -118,4 +357,144 @@ def initializer(_matcher):
 
 def running_process(args):
     index, df_chunk = args
-    return matcher(df_chunk, index)
\ No newline at end of file
+    return matcher.match_frame(df_chunk, index)
+
+'''
+Shared memory mode
+
+The source index, the encoded targets and their random numbers are placed in shared memory
+once, the workers attach to them without copying and write the matched source rows into
+a preallocated shared output array. The random numbers are drawn in the main process, so
+the result is the same as with a single process.
+'''
+
+INDEX_ARRAYS = ["cell_keys", "cell_starts", "cell_counts", "cell_indices"]
+
+def share_array(array):
+    memory = mp.shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype = array.dtype, buffer = memory.buf)
+    shared[...] = array
+    return memory, shared, (memory.name, array.shape, array.dtype.str)
+
+def attach_array(descriptor):
+    name, shape, dtype = descriptor
+    memory = mp.shared_memory.SharedMemory(name = name)
+    return memory, np.ndarray(shape, dtype = dtype, buffer = memory.buf)
+
+def run_shared(matcher, target_matrix, random, process_num, partition = "rows"):
+    arrays = { name : getattr(matcher, name) for name in INDEX_ARRAYS }
+    arrays["target_matrix"] = target_matrix
+    arrays["random"] = random
+    arrays["matched_indices"] = np.ones(len(target_matrix), dtype = np.int64) * (-1)
+    arrays["matched_levels"] = np.ones(len(target_matrix), dtype = np.int8) * (-1)
+
+    memories, shared, descriptors = [], {}, {}
+
+    try:
+        for name, array in arrays.items():
+            memory, shared[name], descriptors[name] = share_array(array)
+            memories.append(memory)
+
+        # Only the small matcher attributes are pickled to the workers
+        bare_matcher = copy.copy(matcher)
+        for name in INDEX_ARRAYS: setattr(bare_matcher, name, None)
+
+        if partition == "strata":
+            chunks = list(enumerate(partition_strata(matcher, target_matrix, process_num)[0]))
+        else:
+            bounds = np.linspace(0, len(target_matrix), process_num + 1).astype(int)
+            chunks = [(index, slice(start, end)) for index, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+        with mp.Pool(processes = process_num, initializer = shared_initializer, initargs = (bare_matcher, descriptors)) as pool:
+            pool.map(shared_running_process, chunks)
+
+        matched_indices = shared["matched_indices"].copy()
+        matched_levels = shared["matched_levels"].copy()
+
+    finally:
+        shared.clear()
+
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+
+    return matched_indices, matched_levels
+
+shared_memories = None
+shared_arrays = None
+
+def shared_initializer(_matcher, descriptors):
+    global matcher, shared_memories, shared_arrays
+    matcher = _matcher
+    shared_memories, shared_arrays = [], {}
+
+    for name, descriptor in descriptors.items():
+        memory, shared_arrays[name] = attach_array(descriptor)
+        shared_memories.append(memory)
+
+    for name in INDEX_ARRAYS:
+        setattr(matcher, name, shared_arrays[name])
+
+def shared_running_process(args):
+    index, rows = args
+    shared_arrays["matched_indices"][rows], shared_arrays["matched_levels"][rows] = matcher.match_matrix(
+        shared_arrays["target_matrix"][rows], shared_arrays["random"][rows], index
+    )
+
+'''
+Stratum partitioning
+
+The targets are sharded by stratum (combination of mandatory attribute values). Strata larger
+than an even share are split, and the pieces are distributed largest first onto the least
+loaded partition. Each worker only receives the source cells of its own strata.
+'''
+
+def partition_strata(matcher, target_matrix, process_num):
+    strata = matcher.make_strata(target_matrix)
+    sorter = np.argsort(strata, kind = "stable")
+    unique_strata, starts, counts = np.unique(strata[sorter], return_index = True, return_counts = True)
+
+    capacity = max(int(np.ceil(len(strata) / process_num)), 1)
+    pieces = [
+        (stratum, piece_start, min(piece_start + capacity, start + count))
+        for stratum, start, count in zip(unique_strata, starts, counts)
+        for piece_start in range(start, start + count, capacity)
+    ]
+    pieces.sort(key = lambda piece: piece[2] - piece[1], reverse = True)
+
+    loads = np.zeros(process_num, dtype = np.int64)
+    rows = [[] for _ in range(process_num)]
+    strata = [set() for _ in range(process_num)]
+
+    for stratum, start, end in pieces:
+        index = np.argmin(loads)
+        loads[index] += end - start
+        rows[index].append(sorter[start:end])
+        strata[index].add(stratum)
+
+    rows = [np.sort(np.concatenate(item)) if len(item) > 0 else np.zeros(0, dtype = np.int64) for item in rows]
+    strata = [sorted(item) for item in strata]
+
+    return rows, strata
+
+def run_strata(matcher, target_matrix, random, process_num):
+    matched_indices = np.ones(len(target_matrix), dtype = np.int64) * (-1)
+    matched_levels = np.ones(len(target_matrix), dtype = np.int8) * (-1)
+
+    partition_rows, partition_strata_keys = partition_strata(matcher, target_matrix, process_num)
+
+    chunks = [
+        (index, matcher.select_strata(strata), target_matrix[rows], random[rows])
+        for index, (rows, strata) in enumerate(zip(partition_rows, partition_strata_keys))
+    ]
+
+    with mp.Pool(processes = process_num) as pool:
+        for rows, (chunk_indices, chunk_levels) in zip(partition_rows, pool.map(strata_running_process, chunks)):
+            matched_indices[rows] = chunk_indices
+            matched_levels[rows] = chunk_levels
+
+    return matched_indices, matched_levels
+
+def strata_running_process(args):
+    index, selected_matcher, target_matrix, random = args
+    return selected_matcher.match_matrix(target_matrix, random, index)
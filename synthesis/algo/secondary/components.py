@@ -1,50 +1,453 @@
 import synthesis.algo.secondary.rda as rda
 import sklearn.neighbors
 import numpy as np
+import pickle
+import os
+
+def compile_distributions(distributions):
+    """
+        Compiles the distance distributions into contiguous arrays per mode: the travel time
+        bounds, the offsets of the bands and the concatenated CDFs and values of all bands.
+    """
+    tables = {}
+
+    for mode, mode_distribution in distributions.items():
+        band_distributions = mode_distribution["distributions"]
+
+        tables[mode] = dict(
+            bounds = np.asarray(mode_distribution["bounds"], dtype = float),
+            offsets = np.cumsum([0] + [len(distribution["cdf"]) for distribution in band_distributions]),
+            cdf = np.concatenate([distribution["cdf"] for distribution in band_distributions]),
+            values = np.concatenate([distribution["values"] for distribution in band_distributions])
+        )
+
+    return tables
 
 class CustomDistanceSampler(rda.FeasibleDistanceSampler):
-    def __init__(self, random, distributions, maximum_iterations = 1000):
-        rda.FeasibleDistanceSampler.__init__(self, random = random, maximum_iterations = maximum_iterations)
+    def __init__(self, random, distributions, maximum_iterations = 1000, vectorized = False):
+        rda.FeasibleDistanceSampler.__init__(self, random = random, maximum_iterations = maximum_iterations, vectorized = vectorized)
 
         self.random = random
         self.distributions = distributions
+        self.tables = compile_distributions(distributions)
+
+    def sample_distances_batch(self, modes, travel_times, random):
+        """
+            Samples one distance per trip for the given modes, travel times and uniform random numbers.
+            The trips are grouped by mode and travel time band, each group is one binary search.
+        """
+        modes = np.asarray(modes)
+        travel_times = np.asarray(travel_times, dtype = float)
+        random = np.asarray(random)
+        distances = np.zeros(len(modes))
+
+        for mode in np.unique(modes):
+            table = self.tables[mode]
+            mode_indices = np.where(modes == mode)[0]
+
+            bands = np.searchsorted(table["bounds"], travel_times[mode_indices])
+            bands[np.isnan(travel_times[mode_indices])] = 0
+
+            for band in np.unique(bands):
+                indices = mode_indices[bands == band]
+                start, end = table["offsets"][band], table["offsets"][band + 1]
+
+                distances[indices] = table["values"][start + np.searchsorted(table["cdf"][start:end], random[indices])]
+
+        return distances
+
+    def make_template(self, problem):
+        # The sampled distances only depend on the mode and the travel time band of every trip
+        bands = [
+            0 if np.isnan(travel_time) else int(np.searchsorted(self.tables[mode]["bounds"], travel_time))
+            for mode, travel_time in zip(problem["modes"], problem["travel_times"])
+        ]
+
+        return (problem["size"],) + tuple(zip(problem["modes"], bands))
 
     def sample_distances(self, problem):
         distances = np.zeros((problem["size"] + 1))
-        #print("Sampling distances")
-        
-        for index, (mode, travel_time) in enumerate(zip(problem["modes"], problem["travel_times"])):
-            mode_distribution = self.distributions[mode]
-            #print(mode_distribution)
+        trip_count = len(problem["modes"])
+
+        distances[:trip_count] = self.sample_distances_batch(
+            problem["modes"], problem["travel_times"], self.random.random_sample(trip_count)
+        )
+
+        return distances
 
-            bound_index = np.count_nonzero(travel_time > mode_distribution["bounds"])
-            mode_distribution = mode_distribution["distributions"][bound_index]
+    def sample_distances_matrix(self, problem, count):
+        distances = np.zeros((count, problem["size"] + 1))
+        trip_count = len(problem["modes"])
 
-            distances[index] = mode_distribution["values"][
-                np.count_nonzero(self.random.random_sample() > mode_distribution["cdf"])
-            ]
+        distances[:, :trip_count] = self.sample_distances_batch(
+            np.tile(problem["modes"], count), np.tile(problem["travel_times"], count),
+            self.random.random_sample(count * trip_count)
+        ).reshape((count, trip_count))
 
         return distances
 
+class PooledDistanceSampler(rda.DistanceSampler):
+    """
+        Shares pools of pre-sampled distance chains between the closed chains of a batch that have
+        the same template (modes and travel time bands). Every pooled chain is stored with the interval
+        of direct distances for which it is feasible, a problem draws a random chain whose interval
+        contains its direct distance. Other problems and templates without a feasible chain are passed
+        to the wrapped sampler.
+    """
+    def __init__(self, sampler, random, pool_size = 1000, minimum_problems = 2):
+        self.sampler = sampler
+        self.random = random
+        self.pool_size = pool_size
+        self.minimum_problems = minimum_problems
+        self.pools = {}
+
+    @property
+    def maximum_iterations(self):
+        return self.sampler.maximum_iterations
+
+    @maximum_iterations.setter
+    def maximum_iterations(self, maximum_iterations):
+        self.sampler.maximum_iterations = maximum_iterations
+
+    def is_pooled(self, problem):
+        return problem["origin"] is not None and problem["destination"] is not None
+
+    def make_pools(self, problems):
+        templates = {}
+
+        for problem in problems:
+            if self.is_pooled(problem):
+                template = self.sampler.make_template(problem)
+                templates.setdefault(template, []).append(problem)
+
+        for template, template_problems in templates.items():
+            if template in self.pools or len(template_problems) < self.minimum_problems:
+                continue
+
+            distances = self.sampler.sample_distances_matrix(template_problems[0], self.pool_size)
+            total_distances = np.sum(distances, axis = 1)
+
+            # Feasible for direct distances in [max(2 * d_i - total, 0), total], see calculate_feasibility
+            self.pools[template] = dict(
+                distances = distances, upper = total_distances,
+                lower = np.maximum(np.max(2.0 * distances - total_distances[:, np.newaxis], axis = 1), 0.0)
+            )
+
+    def sample(self, problem):
+        pool = self.pools.get(self.sampler.make_template(problem)) if self.is_pooled(problem) else None
+
+        if pool is not None:
+            direct_distance = float(np.linalg.norm(problem["destination"] - problem["origin"], axis = 1)[0])
+
+            if direct_distance >= 1e-3 or problem["size"] > 1:
+                candidates = np.flatnonzero((pool["lower"] <= direct_distance) & (direct_distance <= pool["upper"]))
+
+                if len(candidates) > 0:
+                    k = candidates[self.random.randint(len(candidates))]
+                    return dict(valid = True, distances = pool["distances"][k].copy(), iterations = 0)
+
+        return self.sampler.sample(problem)
+
+    def sample_batch(self, problems):
+        self.make_pools(problems)
+        return [self.sample(problem) for problem in problems]
+
 class CustomDiscretizationSolver(rda.DiscretizationSolver):
-    def __init__(self, data):
+    def __init__(self, data, index = "sklearn", workers = 1, candidates = 1, thresholds = None):
         self.data = data
         self.indices = {}
+        self.index = index
+        self.workers = workers
+
+        # With more than one candidate, the nearest facilities of all points of a chain are chosen jointly
+        self.candidates = candidates
+        self.thresholds = thresholds
 
         for purpose, data in self.data.items():
             print("Constructing spatial index for %s ..." % purpose)
-            self.indices[purpose] = sklearn.neighbors.KDTree(data["locations"])
+
+            if index == "scipy":
+                import scipy.spatial
+                self.indices[purpose] = scipy.spatial.cKDTree(data["locations"])
+            else:
+                self.indices[purpose] = sklearn.neighbors.KDTree(data["locations"])
+
+    def query(self, purpose, locations):
+        # Index of the nearest facility for each row of locations
+        if self.index == "scipy":
+            return self.indices[purpose].query(locations, workers = self.workers)[1]
+        else:
+            return self.indices[purpose].query(locations, return_distance = False)[:, 0]
+
+    def query_candidates(self, purpose, locations, count):
+        # Indices of the count nearest facilities for each row of locations, padded with the farthest one
+        available = min(count, len(self.data[purpose]["locations"]))
+
+        if self.index == "scipy":
+            indices = self.indices[purpose].query(locations, k = available, workers = self.workers)[1].reshape(len(locations), available)
+        else:
+            indices = self.indices[purpose].query(locations, k = available, return_distance = False)
+
+        return indices[:, np.minimum(np.arange(count), available - 1)]
 
     def solve(self, problem, locations):
         discretized_locations = []
         discretized_identifiers = []
 
         for location, purpose in zip(locations, problem["purposes"]):
-            index = self.indices[purpose].query(location.reshape(1, -1), return_distance = False)[0][0]
+            index = self.query(purpose, location.reshape(1, -1))[0]
 
             discretized_identifiers.append(self.data[purpose]["identifiers"][index])
             discretized_locations.append(self.data[purpose]["locations"][index])
 
         return dict(
             valid = True, locations = np.vstack(discretized_locations), identifiers = discretized_identifiers
-        )
\ No newline at end of file
+        )
+
+    def solve_batch(self, problems, locations, distances = None):
+        """
+            Collects the relaxed locations of all problems, queries each purpose index once
+            and scatters the identifiers and locations back to the problems.
+        """
+        if len(problems) == 0:
+            return []
+
+        if self.candidates > 1 and distances is not None:
+            return self.solve_joint_batch(problems, locations, distances)
+
+        purposes = np.concatenate([np.asarray(problem["purposes"], dtype = object) for problem in problems])
+        relaxed_locations = np.vstack(locations)
+        offsets = np.cumsum([0] + [len(problem_locations) for problem_locations in locations])
+
+        discretized_locations = np.zeros(relaxed_locations.shape)
+        discretized_identifiers = np.empty(len(purposes), dtype = object)
+
+        for purpose in np.unique(purposes):
+            f = purposes == purpose
+            indices = self.query(purpose, relaxed_locations[f])
+
+            discretized_locations[f] = self.data[purpose]["locations"][indices]
+            discretized_identifiers[f] = self.data[purpose]["identifiers"][indices]
+
+        return [
+            dict(
+                valid = True, locations = discretized_locations[start:end],
+                identifiers = list(discretized_identifiers[start:end])
+            )
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    def solve_joint_batch(self, problems, locations, distances):
+        """
+            Fetches the nearest candidates of every relaxed location and selects for every problem
+            the combination of candidates with the smallest maximum excess discretization error.
+            The radii are the distances to the farthest candidates (infinite if there are fewer
+            facilities than candidates), every closer facility is among the candidates.
+        """
+        purposes = np.concatenate([np.asarray(problem["purposes"], dtype = object) for problem in problems])
+        relaxed_locations = np.vstack(locations)
+        offsets = np.cumsum([0] + [len(problem_locations) for problem_locations in locations])
+
+        candidates = np.zeros((len(purposes), self.candidates), dtype = int)
+        radii = np.full(len(purposes), np.inf)
+
+        for purpose in np.unique(purposes):
+            f = purposes == purpose
+            candidates[f] = self.query_candidates(purpose, relaxed_locations[f], self.candidates)
+
+            if len(self.data[purpose]["locations"]) >= self.candidates:
+                farthest_locations = self.data[purpose]["locations"][candidates[f, -1]]
+                radii[f] = np.sqrt(np.sum((farthest_locations - relaxed_locations[f])**2, axis = 1))
+
+        selection = np.zeros(len(purposes), dtype = int)
+        keys = [(problem["size"], problem["origin"] is None, problem["destination"] is None) for problem in problems]
+
+        for key in set(keys):
+            indices = [index for index, problem_key in enumerate(keys) if problem_key == key]
+            size, has_origin, has_destination = key[0], not key[1], not key[2]
+
+            rows = (offsets[indices][:, np.newaxis] + np.arange(size)).reshape(-1)
+            candidate_locations = np.zeros((len(rows), self.candidates, 2))
+
+            for purpose in np.unique(purposes[rows]):
+                f = purposes[rows] == purpose
+                candidate_locations[f] = self.data[purpose]["locations"][candidates[rows[f]]]
+
+            trip_count = size + 1 - (not has_origin) - (not has_destination)
+
+            selection[rows] = select_candidates(
+                candidate_locations.reshape((len(indices), size, self.candidates, 2)),
+                np.vstack([problems[index]["origin"] for index in indices]) if has_origin else None,
+                np.vstack([problems[index]["destination"] for index in indices]) if has_destination else None,
+                np.vstack([distances[index][:trip_count] for index in indices]),
+                np.vstack([[self.thresholds[mode] for mode in problems[index]["modes"]] for index in indices])
+            ).reshape(-1)
+
+        discretized_locations = np.zeros(relaxed_locations.shape)
+        discretized_identifiers = np.empty(len(purposes), dtype = object)
+        selected = candidates[np.arange(len(purposes)), selection]
+
+        for purpose in np.unique(purposes):
+            f = purposes == purpose
+            discretized_locations[f] = self.data[purpose]["locations"][selected[f]]
+            discretized_identifiers[f] = self.data[purpose]["identifiers"][selected[f]]
+
+        return [
+            dict(
+                valid = True, locations = discretized_locations[start:end],
+                identifiers = list(discretized_identifiers[start:end]), radii = radii[start:end]
+            )
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+def select_candidates(candidates, origins, destinations, distances, thresholds):
+    """
+        Minimax dynamic program along the chains: candidates (P x points x k x 2), origins and
+        destinations (P x 2 or None for tails), sampled distances and thresholds per trip (P x trips).
+        Returns the selected candidate per point (P x points). Ties go to the nearer candidates.
+    """
+    problem_count, point_count, candidate_count = candidates.shape[:3]
+    first_trip = 0 if origins is None else 1
+
+    def excess(a, b, trip):
+        lengths = np.linalg.norm(a[:, :, np.newaxis, :] - b[:, np.newaxis, :, :], axis = 3)
+        return np.maximum(np.abs(lengths - distances[:, trip, np.newaxis, np.newaxis]) - thresholds[:, trip, np.newaxis, np.newaxis], 0.0)
+
+    if origins is None:
+        costs = np.zeros((problem_count, candidate_count))
+    else:
+        costs = excess(origins[:, np.newaxis, :], candidates[:, 0], 0)[:, 0, :]
+
+    backpointers = np.zeros((problem_count, point_count, candidate_count), dtype = int)
+
+    for point in range(1, point_count):
+        step_costs = np.maximum(costs[:, :, np.newaxis], excess(candidates[:, point - 1], candidates[:, point], point - 1 + first_trip))
+        backpointers[:, point] = np.argmin(step_costs, axis = 1)
+        costs = np.min(step_costs, axis = 1)
+
+    if destinations is not None:
+        costs = np.maximum(costs, excess(candidates[:, -1], destinations[:, np.newaxis, :], point_count - 1 + first_trip)[:, :, 0])
+
+    selection = np.zeros((problem_count, point_count), dtype = int)
+    selection[:, -1] = np.argmin(costs, axis = 1)
+
+    for point in range(point_count - 1, 0, -1):
+        selection[:, point - 1] = backpointers[np.arange(problem_count), point, selection[:, point]]
+
+    return selection
+
+def build_facility_index(data, path):
+    """
+        Builds one spatial index over the facilities of all purposes and persists it as .npy files,
+        which workers can memory-map. Facilities offering several purposes are stored once, the
+        purposes are kept as a bit mask per facility.
+    """
+    purposes = sorted(data.keys())
+
+    identifiers = np.concatenate([data[purpose]["identifiers"] for purpose in purposes])
+    locations = np.vstack([data[purpose]["locations"] for purpose in purposes])
+    bits = np.concatenate([np.ones(len(data[purpose]["identifiers"]), dtype = np.uint8) << k for k, purpose in enumerate(purposes)])
+
+    identifiers, first, inverse = np.unique(identifiers, return_index = True, return_inverse = True)
+    locations = locations[first]
+
+    masks = np.zeros(len(identifiers), dtype = np.uint8)
+    np.bitwise_or.at(masks, inverse.reshape(-1), bits)
+
+    print("Constructing shared spatial index for %s ..." % ", ".join(purposes))
+    tree_state = sklearn.neighbors.KDTree(locations).__getstate__()
+
+    os.makedirs(path, exist_ok = True)
+    skeleton = []
+
+    for k, item in enumerate(tree_state):
+        if isinstance(item, np.ndarray):
+            np.save(os.path.join(path, "tree_%d.npy" % k), item)
+            skeleton.append(("array", k))
+        else:
+            skeleton.append(("value", item))
+
+    np.save(os.path.join(path, "identifiers.npy"), identifiers)
+    np.save(os.path.join(path, "locations.npy"), locations)
+    np.save(os.path.join(path, "masks.npy"), masks)
+
+    with open(os.path.join(path, "index.p"), "wb") as f:
+        pickle.dump(dict(purposes = purposes, tree = skeleton), f)
+
+    return path
+
+def load_facility_index(path):
+    # Copy-on-write memory maps, the pages are shared between all processes that load the index
+    with open(os.path.join(path, "index.p"), "rb") as f:
+        meta = pickle.load(f)
+
+    tree_state = tuple([
+        np.load(os.path.join(path, "tree_%d.npy" % item), mmap_mode = "c") if kind == "array" else item
+        for kind, item in meta["tree"]
+    ])
+
+    tree = sklearn.neighbors.KDTree.__new__(sklearn.neighbors.KDTree)
+    tree.__setstate__(tree_state)
+
+    return dict(
+        purposes = meta["purposes"], tree = tree,
+        identifiers = np.load(os.path.join(path, "identifiers.npy"), mmap_mode = "c"),
+        locations = np.load(os.path.join(path, "locations.npy"), mmap_mode = "c"),
+        masks = np.load(os.path.join(path, "masks.npy"), mmap_mode = "c")
+    )
+
+class SharedDiscretizationSolver(CustomDiscretizationSolver):
+    """
+        Discretization on a facility index created by build_facility_index. Queries fetch
+        the nearest facilities and take the first one offering the purpose.
+    """
+    def __init__(self, path, initial_neighbors = 8, candidates = 1, thresholds = None):
+        self.index = "shared"
+        self.initial_neighbors = initial_neighbors
+        self.facilities = load_facility_index(path)
+
+        self.candidates = candidates
+        self.thresholds = thresholds
+
+        # All purposes refer to the same facility arrays
+        self.data = {
+            purpose : dict(identifiers = self.facilities["identifiers"], locations = self.facilities["locations"])
+            for purpose in self.facilities["purposes"]
+        }
+
+        self.bits = { purpose : 1 << k for k, purpose in enumerate(self.facilities["purposes"]) }
+
+    def query(self, purpose, locations):
+        return self.query_candidates(purpose, locations, 1)[:, 0]
+
+    def query_candidates(self, purpose, locations, count):
+        tree, masks = self.facilities["tree"], self.facilities["masks"]
+        facility_count = len(masks)
+
+        indices = np.zeros((len(locations), count), dtype = int)
+        pending = np.arange(len(locations))
+        neighbors = max(self.initial_neighbors, 2 * count)
+
+        while len(pending) > 0:
+            neighbors = min(neighbors, facility_count)
+            candidates = tree.query(locations[pending], k = neighbors, return_distance = False)
+
+            f_purpose = (masks[candidates] & self.bits[purpose]) > 0
+            matches = np.count_nonzero(f_purpose, axis = 1)
+
+            # All facilities have been fetched, there are fewer than count for this purpose
+            f_found = (matches >= count) | ((neighbors == facility_count) & (matches > 0))
+
+            if neighbors == facility_count and not np.all(f_found):
+                raise RuntimeError("No facility found for purpose %s" % purpose)
+
+            # Positions of the first matches, padded with the last one
+            positions = np.argsort(~f_purpose[f_found], axis = 1, kind = "stable")
+            positions = positions[np.arange(len(positions))[:, np.newaxis], np.minimum(np.arange(count), matches[f_found, np.newaxis] - 1)]
+
+            indices[pending[f_found]] = candidates[f_found][np.arange(len(positions))[:, np.newaxis], positions]
+            pending = pending[~f_found]
+
+            neighbors *= 4
+
+        return indices
@@ -60,6 +60,7 @@ def find_assignment_problems(df, df_locations):
 
         elif destination_purpose in FIXED_PURPOSES:
             problem["purposes"] = problem["purposes"][:-1]
+            problem["trip_index"] -= 1 # The first variable activity precedes the first trip
 
         else:
             raise RuntimeError("The presented 'problem' is neither a chain nor a tail")
@@ -89,3 +90,112 @@ def find_assignment_problems(df, df_locations):
         yield problem
 
 
+
+def extract_coordinates(df_locations):
+    """
+        Coordinates of the fixed activities per purpose as float arrays (NaN if the person has none).
+    """
+    coordinates = {}
+
+    for purpose in FIXED_PURPOSES:
+        coordinates[purpose] = np.vstack([
+            [np.nan, np.nan] if not hasattr(point, "x") else [point.x, point.y]
+            for point in df_locations[purpose].values
+        ]).reshape(-1, 2)
+
+    return coordinates
+
+def find_assignment_problems_columnar(df, df_locations):
+    """
+        Vectorized version of find_assignment_problems, the problems are returned as ragged columns:
+          - person_id, trip_index, size per problem (trip_index + 1 is the order of the first variable activity)
+          - trip_offsets into modes and travel_times (all trips of the problem)
+          - purpose_offsets into purposes (variable activities only)
+          - origins and destinations as float coordinates (NaN if the end is not fixed)
+    """
+    person_ids = df["person_id"].values
+    trip_ids = df["trip_id"].values
+    preceeding_purposes = df["preceeding_purpose"].values
+    following_purposes = df["following_purpose"].values
+
+    # A problem ends with a fixed activity or with the last trip of the person (tail)
+    f_end = np.isin(following_purposes, FIXED_PURPOSES)
+    f_end[:-1] |= person_ids[:-1] != person_ids[1:]
+    if len(f_end) > 0: f_end[-1] = True
+
+    ends = np.where(f_end)[0]
+    starts = np.hstack([[0], ends[:-1] + 1]).astype(int)
+
+    origin_purposes = preceeding_purposes[starts]
+    destination_purposes = following_purposes[ends]
+    has_origin = np.isin(origin_purposes, FIXED_PURPOSES)
+    has_destination = np.isin(destination_purposes, FIXED_PURPOSES)
+
+    if np.any(~has_origin & ~has_destination):
+        raise RuntimeError("The presented 'problem' is neither a chain nor a tail")
+
+    # Define size and skip problems without variable activities
+    sizes = ends - starts + 2 - has_origin - has_destination
+    f = sizes > 0
+
+    starts, ends, sizes = starts[f], ends[f], sizes[f]
+    origin_purposes, destination_purposes = origin_purposes[f], destination_purposes[f]
+    has_origin, has_destination = has_origin[f], has_destination[f]
+
+    trip_offsets = np.hstack([[0], np.cumsum(ends - starts + 1)]).astype(int)
+    trip_rows = np.repeat(starts, ends - starts + 1) + np.arange(trip_offsets[-1]) - np.repeat(trip_offsets[:-1], ends - starts + 1)
+
+    # Variable purposes: following purposes of the trips without the fixed destination, preceded by a non-fixed origin
+    purpose_offsets = np.hstack([[0], np.cumsum(sizes)]).astype(int)
+    purpose_positions = np.arange(purpose_offsets[-1]) - np.repeat(purpose_offsets[:-1], sizes) - np.repeat(~has_origin, sizes)
+    purpose_rows = np.repeat(starts, sizes) + np.maximum(purpose_positions, 0)
+    purposes = np.where(purpose_positions < 0, preceeding_purposes[purpose_rows], following_purposes[purpose_rows])
+
+    # Locations of the fixed activities
+    location_person_ids = df_locations["person_id"].values
+    location_rows = np.searchsorted(location_person_ids, person_ids[starts])
+
+    coordinates = extract_coordinates(df_locations)
+
+    origins = np.ones((len(starts), 2)) * np.nan
+    destinations = np.ones((len(starts), 2)) * np.nan
+
+    for purpose in FIXED_PURPOSES:
+        f_origin = origin_purposes == purpose
+        origins[f_origin] = coordinates[purpose][location_rows[f_origin]]
+
+        f_destination = destination_purposes == purpose
+        destinations[f_destination] = coordinates[purpose][location_rows[f_destination]]
+
+    # Without a fixed origin the first variable activity precedes the first trip of the problem
+    trip_indices = trip_ids[starts] - ~has_origin
+
+    return dict(
+        person_id = person_ids[starts], trip_index = trip_indices, size = sizes,
+        trip_offsets = trip_offsets, modes = df["mode"].values[trip_rows], travel_times = df["travel_time"].values[trip_rows],
+        purpose_offsets = purpose_offsets, purposes = purposes,
+        origins = origins, destinations = destinations,
+        has_origin = has_origin, has_destination = has_destination
+    )
+
+def make_problems(columns):
+    """
+        Creates the problem dictionaries that are used by the solvers from the columnar problems.
+    """
+    problems = []
+
+    for index in range(len(columns["size"])):
+        trip_start, trip_end = columns["trip_offsets"][index], columns["trip_offsets"][index + 1]
+        purpose_start, purpose_end = columns["purpose_offsets"][index], columns["purpose_offsets"][index + 1]
+
+        problems.append(dict(
+            person_id = columns["person_id"][index], trip_index = columns["trip_index"][index],
+            purposes = columns["purposes"][purpose_start:purpose_end],
+            modes = columns["modes"][trip_start:trip_end],
+            travel_times = columns["travel_times"][trip_start:trip_end],
+            size = int(columns["size"][index]),
+            origin = columns["origins"][index:index + 1] if columns["has_origin"][index] else None,
+            destination = columns["destinations"][index:index + 1] if columns["has_destination"][index] else None
+        ))
+
+    return problems
@@ -1,4 +1,5 @@
 import numpy as np
+import time
 import numpy.linalg as la
 import geopandas as gpd
 from shapely.geometry import Polygon, LineString, Point
@@ -18,26 +19,54 @@ def calculate_feasibility(distances, direct_distance, consider_total_distance =
 
     return float(max(delta, 0))
 
+def calculate_feasibility_matrix(distances, direct_distance, consider_total_distance = True):
+    """
+        Row-wise version of calculate_feasibility for a matrix of distance chains.
+    """
+    total_distance = np.sum(distances, axis = 1)
+
+    remaining_distance = total_distance[:, np.newaxis] - distances
+    delta = np.max(distances - direct_distance - remaining_distance, axis = 1)
+
+    if consider_total_distance:
+        delta = np.maximum(delta, direct_distance - total_distance)
+
+    return np.maximum(delta, 0.0)
+
 class DiscretizationSolver:
     def solve(self, problem, locations):
         raise NotImplementedError()
 
+    def solve_batch(self, problems, locations, distances = None):
+        # Sampled distances are passed for solvers that take the trips into account
+        return [self.solve(problem, problem_locations) for problem, problem_locations in zip(problems, locations)]
+
 class RelaxationSolver:
     def solve(self, problem, distances):
         raise NotImplementedError()
 
+    def solve_batch(self, problems, distances):
+        return [self.solve(problem, problem_distances) for problem, problem_distances in zip(problems, distances)]
+
 class DistanceSampler:
     def sample(self, problem):
         raise NotImplementedError()
 
+    def sample_batch(self, problems):
+        return [self.sample(problem) for problem in problems]
+
 class AssignmentObjective:
     def evaluate(self, problem, distance_result, relaxation_result, discretization_result):
         raise NotImplementedError()
 
 class AssignmentSolver:
-    def __init__(self, distance_sampler, relaxation_solver, discretization_solver, objective, maximum_iterations = 1000):
+    def __init__(self, distance_sampler, relaxation_solver, discretization_solver, objective, maximum_iterations = 1000, budgets = None, maximum_samples = None):
         self.maximum_iterations = maximum_iterations
 
+        # Escalating passes of (assignment iterations, sampler iterations) and a cap on the sampled chains of a batch
+        self.budgets = budgets
+        self.maximum_samples = maximum_samples
+
         self.relaxation_solver = relaxation_solver
         self.distance_sampler = distance_sampler
         self.discretization_solver = discretization_solver
@@ -69,59 +98,184 @@ class AssignmentSolver:
 
         return best_result
 
+    def solve_batch(self, problems):
+        """
+            Solves many problems at once, every iteration processes all problems
+            which do not have a valid result yet in one batch per component.
+
+            With budgets, the problems are first solved with a small budget and only the failures
+            are solved again in the following passes with larger budgets. Once the sampled chains
+            would exceed maximum_samples, the remaining problems keep their best result. Every result
+            records its pass and the iteration limits of that pass.
+        """
+        best_results = [None] * len(problems)
+        pending = list(range(len(problems)))
+
+        budgets = self.budgets if self.budgets is not None else [(self.maximum_iterations, None)]
+        samples = 0
+
+        # Time per phase (sampling, relaxation, discretization), shared equally by the problems of a batch
+        timings = np.zeros((len(problems), 3))
+        exhausted = False
+
+        # The sampler limit is raised per pass and restored afterwards, later calls use the configured limit
+        original_sampler_iterations = getattr(self.distance_sampler, "maximum_iterations", None)
+
+        try:
+            for budget, (maximum_iterations, sampler_iterations) in enumerate(budgets):
+                if sampler_iterations is not None:
+                    self.distance_sampler.maximum_iterations = sampler_iterations
+
+                # Budget as actually used, the sampler keeps its own limit if the pass does not set one
+                budget_limits = (maximum_iterations, getattr(self.distance_sampler, "maximum_iterations", None))
+
+                for assignment_iteration in range(maximum_iterations):
+                    if len(pending) == 0 or exhausted:
+                        break
+
+                    # Every problem is attempted at least once
+                    cost = len(pending) * getattr(self.distance_sampler, "maximum_iterations", 1)
+
+                    if self.maximum_samples is not None and samples + cost > self.maximum_samples and (budget > 0 or assignment_iteration > 0):
+                        exhausted = True
+                        break
+
+                    samples += cost
+                    batch = [problems[index] for index in pending]
+
+                    start_time = time.perf_counter()
+                    distance_results = self.distance_sampler.sample_batch(batch)
+                    sampling_time = time.perf_counter()
+                    relaxation_results = self.relaxation_solver.solve_batch(batch, [result["distances"] for result in distance_results])
+                    relaxation_time = time.perf_counter()
+                    discretization_results = self.discretization_solver.solve_batch(batch,
+                        [result["locations"] for result in relaxation_results], [result["distances"] for result in distance_results])
+                    discretization_time = time.perf_counter()
+
+                    timings[pending] += np.array([
+                        sampling_time - start_time, relaxation_time - sampling_time, discretization_time - relaxation_time
+                    ]) / len(pending)
+
+                    for index, problem, distance_result, relaxation_result, discretization_result in zip(
+                        pending, batch, distance_results, relaxation_results, discretization_results):
+
+                        assignment_result = self.objective.evaluate(problem, distance_result, relaxation_result, discretization_result)
+
+                        if best_results[index] is None or assignment_result["objective"] < best_results[index]["objective"]:
+                            best_results[index] = assignment_result
+
+                            assignment_result["distance"] = distance_result
+                            assignment_result["relaxation"] = relaxation_result
+                            assignment_result["discretization"] = discretization_result
+                            assignment_result["iterations"] = assignment_iteration
+
+                        best_results[index]["budget"] = budget
+                        best_results[index]["budget_iterations"], best_results[index]["budget_sampler_iterations"] = budget_limits
+
+                    pending = [index for index in pending if not best_results[index]["valid"]]
+        finally:
+            if hasattr(self.distance_sampler, "maximum_iterations"):
+                self.distance_sampler.maximum_iterations = original_sampler_iterations
+
+        for index, result in enumerate(best_results):
+            result["timings"] = dict(sampling = timings[index, 0], relaxation = timings[index, 1], discretization = timings[index, 2])
+
+        return best_results
+
 class ChainTailRelaxationSolver(RelaxationSolver):
     def __init__(self, chain_solver, tail_solver):
         self.chain_solver = chain_solver
         self.tail_solver = tail_solver
 
-    def solve(self, problem, distances):
+    def is_tail(self, problem):
         if problem["origin"] is None and problem["destination"] is None:
             raise RuntimeError("Both origin and destination are not available")
 
-        elif problem["origin"] is None or problem["destination"] is None:
+        return problem["origin"] is None or problem["destination"] is None
+
+    def solve(self, problem, distances):
+        if self.is_tail(problem):
             return self.tail_solver.solve(problem, distances)
 
         else:
             return self.chain_solver.solve(problem, distances)
 
+    def solve_batch(self, problems, distances):
+        """
+            Passes all tails in one batch to the tail solver and all chains in one batch to the chain solver.
+        """
+        results = [None] * len(problems)
+        f_tail = np.array([self.is_tail(problem) for problem in problems], dtype = bool)
+
+        for solver, indices in ((self.tail_solver, np.where(f_tail)[0]), (self.chain_solver, np.where(~f_tail)[0])):
+            if len(indices) > 0:
+                solver_results = solver.solve_batch([problems[index] for index in indices], [distances[index] for index in indices])
+
+                for index, result in zip(indices, solver_results):
+                    results[index] = result
+
+        return results
+
 class AngularTailSolver(RelaxationSolver):
     def __init__(self, random):
         self.random = random
 
     def solve(self, problem, distances):
-        anchor, reverse = None, None
+        return self.solve_batch([problem], [distances])[0]
 
-        if problem["origin"] is None:
-            anchor = problem["destination"]
-            reverse = False
+    def solve_batch(self, problems, distances):
+        """
+            Places the variable activities of all tails at once: every trip gets a random direction,
+            the locations are the cumulative offsets from the fixed end of the tail. Tails without an
+            origin are walked backwards from their destination.
+        """
+        if len(problems) == 0:
+            return []
 
-        elif problem["destination"] is None:
-            anchor = problem["origin"]
-            reverse = True
+        sizes = np.array([problem["size"] for problem in problems], dtype = int)
+        offsets = np.hstack([[0], np.cumsum(sizes)])
+        f_reverse = np.array([problem["origin"] is None for problem in problems], dtype = bool)
 
-        else:
-            raise RuntimeError("Invalid chain for AngularTailSolver")
+        for problem in problems:
+            if (problem["origin"] is None) == (problem["destination"] is None):
+                raise RuntimeError("Invalid chain for AngularTailSolver")
+
+        anchors = np.vstack([
+            problem["destination"] if reverse else problem["origin"]
+            for problem, reverse in zip(problems, f_reverse)
+        ])
+
+        # A tail has as many trips as variable activities, the trips of reversed tails are walked from the end
+        steps = np.concatenate([
+            problem_distances[:size][::-1] if reverse else problem_distances[:size]
+            for problem_distances, size, reverse in zip(distances, sizes, f_reverse)
+        ])
 
-        angles = self.random.random_sample(len(distances)) * 2.0 * np.pi
-        offsets = np.vstack([np.cos(angles), np.sin(angles)]).T * distances[:, np.newaxis]
+        angles = self.random.random_sample(len(steps)) * 2.0 * np.pi
+        step_offsets = np.vstack([np.cos(angles), np.sin(angles)]).T * steps[:, np.newaxis]
 
-        locations = [anchor]
+        cumulative_offsets = np.cumsum(step_offsets, axis = 0)
+        cumulative_offsets -= np.repeat(np.vstack([np.zeros((1, 2)), cumulative_offsets])[offsets[:-1]], sizes, axis = 0)
+        locations = np.repeat(anchors, sizes, axis = 0) + cumulative_offsets
 
-        for k in range(len(reference)):
-            locations.append(locations[-1] + offsets[k])
+        results = []
 
-        locations = np.vstack(locations[1:])
-        if reverse: locations = locations[::-1,:]
+        for start, end, reverse in zip(offsets[:-1], offsets[1:], f_reverse):
+            problem_locations = locations[start:end]
+            if reverse: problem_locations = problem_locations[::-1]
 
-        return dict(valid = True, locations = locations)
+            results.append(dict(valid = True, locations = problem_locations, iterations = None))
 
-class GravityChainSolver:
-    def __init__(self, random, alpha = 0.3, eps = 1.0, maximum_iterations = 1000, lateral_deviation = None):
+        return results
+
+class GravityChainSolver(RelaxationSolver):
+    def __init__(self, random, alpha = 0.3, eps = 1.0, maximum_iterations = 1000, lateral_deviation = None, starts = 1):
         self.alpha = 0.3
         self.eps = 1e-2
         self.maximum_iterations = maximum_iterations
         self.random = random
         self.lateral_deviation = lateral_deviation
+        self.starts = starts # lateral deviation starts per distance vector in solve_batch
 
     def solve_two_points(self, problem, origin, destination, distances, direction, direct_distance):
         if direct_distance == 0.0:
@@ -259,15 +413,196 @@ class GravityChainSolver:
             valid = valid, locations = locations[1:-1], iterations = k
         )
 
+    def solve_batch(self, problems, distances):
+        """
+            Groups the problems by size and solves each group as one stacked array problem.
+        """
+        results = [None] * len(problems)
+        sizes = np.array([problem["size"] for problem in problems])
+
+        for size in np.unique(sizes):
+            indices = np.where(sizes == size)[0]
+
+            origins = np.vstack([problems[index]["origin"] for index in indices])
+            destinations = np.vstack([problems[index]["destination"] for index in indices])
+            size_distances = np.vstack([distances[index] for index in indices])
+
+            if size == 1:
+                result = self.solve_two_points_arrays(origins, destinations, size_distances)
+            elif self.starts > 1:
+                result = self.solve_arrays_multistart(origins, destinations, size_distances)
+            else:
+                result = self.solve_arrays(origins, destinations, size_distances)
+
+            for k, index in enumerate(indices):
+                results[index] = dict(
+                    valid = bool(result["valid"][k]), locations = result["locations"][k],
+                    iterations = None if result["iterations"][k] < 0 else int(result["iterations"][k])
+                )
+
+        return results
+
+    def prepare_directions(self, origins, destinations):
+        direct_distances = la.norm(destinations - origins, axis = 1)
+        directions = np.zeros_like(origins, dtype = float)
+
+        f_zero = direct_distances < 1e-12 # We have a zero direct distance, choose a direction randomly
+        angles = self.random.random_sample(np.count_nonzero(f_zero)) * np.pi * 2.0
+        directions[f_zero] = np.vstack([np.cos(angles), np.sin(angles)]).T
+        directions[~f_zero] = (destinations[~f_zero] - origins[~f_zero]) / direct_distances[~f_zero, np.newaxis]
+
+        normals = np.vstack([directions[:, 1], -directions[:, 0]]).T
+        return direct_distances, directions, normals
+
+    def solve_two_points_arrays(self, origins, destinations, distances):
+        """
+            Vectorized version of solve_two_points for problems with one variable point.
+            Returns valid (P), locations (P x 1 x 2) and iterations (P, always -1).
+        """
+        direct_distances, directions, normals = self.prepare_directions(origins, destinations)
+
+        first, second = distances[:, 0], distances[:, 1]
+        total = first + second
+        ratios = np.ones(len(origins))
+        ratios[total > 0.0] = first[total > 0.0] / total[total > 0.0]
+
+        f_zero = direct_distances == 0.0
+        f_far = ~f_zero & (direct_distances > total)
+        f_close = ~f_zero & ~f_far & (direct_distances < np.abs(first - second))
+        f_circle = ~f_zero & ~f_far & ~f_close
+
+        scales = np.zeros(len(origins))
+        scales[f_zero] = first[f_zero]
+        scales[f_far] = ratios[f_far] * direct_distances[f_far]
+        scales[f_close] = ratios[f_close] * np.maximum(first, second)[f_close]
+
+        A = 0.5 * (first[f_circle]**2 - second[f_circle]**2 + direct_distances[f_circle]**2) / direct_distances[f_circle]
+        H = np.sqrt(np.maximum(0, first[f_circle]**2 - A**2))
+        sides = np.where(self.random.random_sample(len(A)) < 0.5, 1.0, -1.0)
+        scales[f_circle] = A
+
+        locations = origins + directions * scales[:, np.newaxis]
+        locations[f_circle] += normals[f_circle] * (sides * H)[:, np.newaxis]
+
+        valid = f_circle.copy()
+        valid[f_zero] = first[f_zero] == second[f_zero]
+
+        return dict(
+            valid = valid, locations = locations[:, np.newaxis, :], iterations = -np.ones(len(origins), dtype = int)
+        )
+
+    def solve_arrays(self, origins, destinations, distances):
+        """
+            Runs the gravity simulation for many problems of the same size at once.
+            Takes origins (P x 2), destinations (P x 2) and distances (P x trips), returns
+            valid (P), locations (P x points x 2) and iterations (P, -1 if not simulated).
+        """
+        problem_count, trip_count = distances.shape
+        direct_distances, directions, normals = self.prepare_directions(origins, destinations)
+
+        # Prepare initial locations
+        total_distances = np.sum(distances, axis = 1)
+        shares = np.cumsum(distances[:, :-1], axis = 1) / np.maximum(total_distances, 1e-12)[:, np.newaxis]
+        shares[total_distances < 1e-12] = np.linspace(0, 1, trip_count - 1)
+
+        locations = np.zeros((problem_count, trip_count + 1, 2))
+        locations[:, 0] = origins
+        locations[:, 1:-1] = origins[:, np.newaxis, :] + directions[:, np.newaxis, :] * (shares * direct_distances[:, np.newaxis])[:, :, np.newaxis]
+        locations[:, -1] = destinations
+
+        # We still return some locations for infeasible problems although they may not be perfect
+        remaining_distances = total_distances[:, np.newaxis] - distances
+        deltas = np.maximum(np.max(distances - direct_distances[:, np.newaxis] - remaining_distances, axis = 1), direct_distances - total_distances)
+        f_feasible = np.maximum(deltas, 0.0) == 0.0
+
+        # Add lateral devations
+        lateral_deviations = np.ones(problem_count) * self.lateral_deviation if not self.lateral_deviation is None else np.maximum(direct_distances, 1.0)
+        deviations = 2.0 * (self.random.normal(size = (np.count_nonzero(f_feasible), trip_count - 1)) - 0.5) * lateral_deviations[f_feasible, np.newaxis]
+        locations[f_feasible, 1:-1] += normals[f_feasible, np.newaxis, :] * deviations[:, :, np.newaxis]
+
+        # Prepare gravity simulation
+        valid = np.zeros(problem_count, dtype = bool)
+        iterations = -np.ones(problem_count, dtype = int)
+
+        origin_weights = np.ones((trip_count - 1, 2))
+        origin_weights[0,:] = 2.0
+
+        destination_weights = np.ones((trip_count - 1, 2))
+        destination_weights[-1,:] = 2.0
+
+        # Run gravity simulation on the problems which have not converged yet
+        active = np.where(f_feasible)[0]
+
+        for k in range(self.maximum_iterations):
+            if len(active) == 0:
+                break
+
+            active_locations = locations[active]
+            active_directions = active_locations[:, :-1] - active_locations[:, 1:]
+            lengths = la.norm(active_directions, axis = 2)
+
+            offset = distances[active] - lengths
+            lengths[lengths < 1.0] = 1.0
+            active_directions /= lengths[:, :, np.newaxis]
+
+            f_converged = np.all(np.abs(offset) < self.eps, axis = 1) # Check if we have converged
+            valid[active[f_converged]] = True
+            iterations[active] = k
+
+            active = active[~f_converged]
+            offset, active_directions = offset[~f_converged], active_directions[~f_converged]
+
+            # Apply adjustment to locations
+            adjustment = np.zeros((len(active), trip_count - 1, 2))
+            adjustment -= 0.5 * self.alpha * offset[:, :-1, np.newaxis] * active_directions[:, :-1] * origin_weights
+            adjustment += 0.5 * self.alpha * offset[:, 1:, np.newaxis] * active_directions[:, 1:] * destination_weights
+
+            locations[active, 1:-1] += adjustment
+
+            if np.isnan(locations[active]).any() or np.isinf(locations[active]).any():
+                raise RuntimeError("NaN/Inf value encountered during gravity simulation")
+
+        # Largest remaining deviation from the sampled distances
+        residuals = np.max(np.abs(distances - la.norm(locations[:, :-1] - locations[:, 1:], axis = 2)), axis = 1)
+
+        return dict(
+            valid = valid, locations = locations[:, 1:-1], iterations = iterations, residuals = residuals
+        )
+
+    def solve_arrays_multistart(self, origins, destinations, distances):
+        """
+            Runs the gravity simulation from several random lateral deviations for every problem
+            in one stacked computation and keeps the start with the smallest residual.
+        """
+        problem_count = len(origins)
+
+        result = self.solve_arrays(
+            np.repeat(origins, self.starts, axis = 0), np.repeat(destinations, self.starts, axis = 0),
+            np.repeat(distances, self.starts, axis = 0)
+        )
+
+        residuals = np.where(result["valid"], -1.0, result["residuals"]).reshape((problem_count, self.starts))
+        selection = np.arange(problem_count) * self.starts + np.argmin(residuals, axis = 1)
+
+        return dict(
+            valid = result["valid"][selection], locations = result["locations"][selection],
+            iterations = result["iterations"][selection], residuals = result["residuals"][selection]
+        )
+
 class FeasibleDistanceSampler(DistanceSampler):
-    def __init__(self, random, maximum_iterations = 1000):
+    def __init__(self, random, maximum_iterations = 1000, vectorized = False):
         self.maximum_iterations = maximum_iterations
         self.random = random
+        self.vectorized = vectorized
 
     def sample_distances(self, problem):
         # Return distance chains per row
         raise NotImplementedError()
 
+    def sample_distances_matrix(self, problem, count):
+        # Return a matrix of count distance chains, one chain per row
+        return np.vstack([self.sample_distances(problem) for k in range(count)])
+
     def sample(self, problem):
         origin, destination = problem["origin"], problem["destination"]
 
@@ -278,7 +613,7 @@ class FeasibleDistanceSampler(DistanceSampler):
             distances = self.sample_distances(problem)
             return dict(valid = True, distances = distances, iterations = None)
 
-        direct_distance = la.norm(destination - origin, axis = 1)
+        direct_distance = float(la.norm(destination - origin, axis = 1)[0])
 
         # One point and two trips
         if direct_distance < 1e-3 and problem["size"] == 1:
@@ -288,6 +623,9 @@ class FeasibleDistanceSampler(DistanceSampler):
             return dict(valid = True, distances = distances, iterations = None)
 
         # This is the general case
+        if self.vectorized:
+            return self.sample_vectorized(problem, direct_distance)
+
         best_distances = None
         best_delta = None
 
@@ -311,6 +649,23 @@ class FeasibleDistanceSampler(DistanceSampler):
             iterations = k
         )
 
+    def sample_vectorized(self, problem, direct_distance):
+        """
+            Draws all candidate chains at once and picks the first feasible one,
+            or the first one with the smallest feasibility delta.
+        """
+        distances = self.sample_distances_matrix(problem, self.maximum_iterations)
+        deltas = calculate_feasibility_matrix(distances, direct_distance)
+
+        k = int(np.argmin(deltas))
+        valid = deltas[k] == 0.0
+
+        return dict(
+            valid = valid,
+            distances = distances[k],
+            iterations = k if valid else self.maximum_iterations - 1
+        )
+
 class DiscretizationErrorObjective(AssignmentObjective):
     def __init__(self, thresholds):
         self.thresholds = thresholds
@@ -318,12 +673,14 @@ class DiscretizationErrorObjective(AssignmentObjective):
     def evaluate(self, problem, distance_result, relaxation_result, discretization_result):
         sampled_distances = distance_result["distances"]
 
-        discretized_locations = np.vstack((
-            problem["origin"], discretization_result["locations"], problem["destination"]
-        ))
+        # Tails do not have a fixed origin or destination and one trip less than chains
+        discretized_locations = np.vstack([
+            locations for locations in (problem["origin"], discretization_result["locations"], problem["destination"])
+            if locations is not None
+        ])
         discretized_distances = la.norm(discretized_locations[:-1] - discretized_locations[1:], axis = 1)
 
-        discretization_error = np.abs(sampled_distances - discretized_distances)
+        discretization_error = np.abs(sampled_distances[:len(discretized_distances)] - discretized_distances)
 
         objective = 0.0
         for error, mode in zip(discretization_error, problem["modes"]):
@@ -52,6 +52,9 @@ def configure(context):
     context.config("district_mapping_file") #data sensitive
     context.config("matching_processes")
     context.config("matching_minimum_samples")
+    context.config("matching_shared_memory", False)
+    context.config("matching_partition", "rows") # rows / strata
+    context.config("matching_cache_path", None) # directory for the compiled matching index
 
     context.stage("data.census.clean_census")
     context.stage("data.hts.clean_travel_survey")
@@ -108,15 +111,26 @@ def execute(context):
     df_target.to_csv(context.config("output_path")+"/csv/clean_census_matched.csv")
     
     
-    synthesis.algo.hot_deck_matching.run(
+    matching_statistics = synthesis.algo.hot_deck_matching.run(
         df_target, df_source,
         "traveler_id",
         ["age_class", "sex", "employment"],
         ['district_name'],
         minimum_source_samples = context.config("matching_minimum_samples"),
-        process_num = context.config("matching_processes")
+        process_num = context.config("matching_processes"),
+        use_shared_memory = context.config("matching_shared_memory"),
+        partition = context.config("matching_partition"),
+        cache_path = context.config("matching_cache_path")
     )
 
+    print("Matching times [s]:", ", ".join(["%s %.2f" % item for item in matching_statistics["timings"].items()]))
+    print("Relaxation levels (-1 = unmatched):")
+    print(df_target["hdm_relaxation_level"].value_counts().sort_index())
+    df_cells = matching_statistics["cells"]
+    print("Smallest donor pools:")
+    print(df_cells.sort_values(by = "pool_size").head(10))
+    df_cells.to_csv(context.config("output_path")+"/csv/matching_cells.csv")
+
     #remove non-matched people from census
     unmatched = df_target.loc[df_target['hdm_source_id'] == -1]
     print("Unmatched (#) in census:",len(unmatched))
@@ -1,8 +1,6 @@
 from numpy.core.numeric import empty_like
 import pandas as pd
 import numpy as np
-import geopandas as gpd
-from tqdm import tqdm
 from shapely.geometry import Point
 
 """
@@ -22,60 +20,45 @@ def configure(context):
 
 
 def extract_facility_candidates(f_kk, df_workplaces, sample_seed, zones):
-    C_kk = pd.DataFrame(columns=["commute_point","commute_zone_id", "home_zone_id"])
     print(df_workplaces.head())
-    
-    workplace_points = np.array([])
-    commute_zones = np.array([])
-    home_zones = np.array([])
-    no_workplace = 0
-
-    for zone, df_org in tqdm(f_kk.groupby("origin")):
-        trips_cum = 0
-        if(zone == 999):
-            print("Home destination is outside Prague.")
-
-        for i, df_dest in df_org.iterrows():
-            dest = df_dest.destination
-            n_trips = df_dest.trip_count
-            trips_cum +=n_trips
-            
-            if(n_trips > 0):
-                if(df_workplaces[df_workplaces.zone_id == dest].shape[0] > 0):
-                    samples = df_workplaces[df_workplaces.zone_id == dest].sample(n=n_trips, replace=True, 
-                                    weights=None, random_state=sample_seed)
-                    if(len(samples) < n_trips):
-                        print("Less samples than trips!")
-
-                    workplace_points = np.append(workplace_points, samples.geometry)
-                else:
-                    #print("no destinations", dest)
-                    if(dest != 999):
-                        no_workplace += n_trips
-                        centroid = zones[zones.zone_id == dest].zone_centroid
-                    else:
-                        no_workplace += n_trips
-                        centroid = gpd.GeoSeries([Point(-1.0, -1.0)])
-                    #print(centroid, type(centroid))
-                    workplace_points = np.append(workplace_points,[centroid]*n_trips)
-                
-                commute_zones = np.append(commute_zones,[dest]*n_trips)
-                if(len(commute_zones) != len(workplace_points)):
-                    print(n_trips)
-                    print("Commute", len(commute_zones), len(workplace_points))
-                    break
-        
-        home_zones = np.append(home_zones,[zone]*trips_cum)
-
-        if(len(home_zones) != len(workplace_points)):
-            print("Home")
-            break
-
-            
-    #print(len(workplace_points), len(commute_zones), len(home_zones))
-    C_kk.commute_point = workplace_points
-    C_kk.commute_zone_id = commute_zones
-    C_kk.home_zone_id = home_zones
+    random = np.random.RandomState(sample_seed)
+
+    # Workplaces sorted by zone once, each zone is a contiguous range
+    df_workplaces = df_workplaces.sort_values(by = "zone_id", kind = "stable")
+    workplace_zones = df_workplaces.zone_id.values
+    workplace_points = df_workplaces.geometry.values
+
+    f_kk = f_kk.sort_values(by = "origin", kind = "stable")
+    f_kk = f_kk[f_kk.trip_count > 0]
+
+    if((f_kk.origin == 999).any()):
+        print("Home destination is outside Prague.")
+
+    trip_counts = f_kk.trip_count.values.astype(int)
+    home_zones = np.repeat(f_kk.origin.values, trip_counts)
+    commute_zones = np.repeat(f_kk.destination.values, trip_counts)
+
+    # Draw a workplace with replacement for every trip at once
+    starts = np.repeat(np.searchsorted(workplace_zones, f_kk.destination.values, side = "left"), trip_counts)
+    counts = np.repeat(np.searchsorted(workplace_zones, f_kk.destination.values, side = "right"), trip_counts) - starts
+
+    f_sampled = counts > 0
+    indices = starts + np.minimum((random.random_sample(len(starts)) * counts).astype(int), np.maximum(counts - 1, 0))
+
+    commute_points = np.empty((len(starts),), dtype = object)
+    commute_points[f_sampled] = workplace_points[indices[f_sampled]]
+
+    # Zones without workplaces receive their centroid, destinations outside (999) a placeholder
+    centroids = dict(zip(zones.zone_id.values, zones.zone_centroid.values))
+
+    for zone in np.unique(commute_zones[~f_sampled]):
+        f = ~f_sampled & (commute_zones == zone)
+        commute_points[f] = centroids[zone] if zone != 999 and zone in centroids else Point(-1.0, -1.0)
+
+    C_kk = pd.DataFrame(dict(
+        commute_point = commute_points, commute_zone_id = commute_zones, home_zone_id = home_zones
+    ))
+
     print("Cumulative number of trips:", f_kk.trip_count.sum())
     print("Mass of trips available:", len(C_kk))
     return C_kk
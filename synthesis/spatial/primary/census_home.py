@@ -1,6 +1,5 @@
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
 
 
 """
@@ -14,13 +13,52 @@ def configure(context):
     context.stage("data.spatial.home")
 
 """
-Sample number of houses for the people living in the zone
+Sample houses for the people of all zones at once
 """
 
-def assign_houses(df_people, df_houses, seed):
-    houses = df_houses.sample(n = len(df_people), weights='resident_number', replace = True, random_state = seed)
-    df_people.loc[:,'residence_id'] = houses['residence_id'].values
-    assigned_houses = df_people[['person_id', 'residence_id']].values
+def assign_houses_grouped(df_census, df_home, seed):
+    # Houses and people sorted by zone once, each zone is a contiguous range
+    df_home = df_home.sort_values(by = 'zone_id', kind = 'stable')
+    df_census = df_census.sort_values(by = 'zone_id', kind = 'stable')
+
+    house_zones = df_home['zone_id'].values
+    people_zones = df_census['zone_id'].values
+    zones, people_counts = np.unique(people_zones, return_counts = True)
+
+    # Missing weights count as zero like in DataFrame.sample, negative weights are invalid
+    weights = df_home['resident_number'].values.astype(float)
+
+    if np.any(weights < 0.0):
+        raise RuntimeError("Houses with negative resident_number")
+
+    # Cumulative resident_number weights over all houses, a zone covers [lower, upper)
+    cumulative_weights = np.cumsum(np.nan_to_num(weights, nan = 0.0))
+    starts = np.searchsorted(house_zones, zones, side = 'left')
+    ends = np.searchsorted(house_zones, zones, side = 'right')
+
+    lower = np.hstack([[0.0], cumulative_weights])[starts]
+    upper = np.hstack([[0.0], cumulative_weights])[ends]
+
+    f_houses = upper > lower
+    if not np.all(f_houses):
+        raise RuntimeError("No houses with residents in zones %s for %d people" % (
+            zones[~f_houses].tolist(), np.sum(people_counts[~f_houses])))
+
+    # Every zone draws from its own substream of the seed
+    uniforms = np.concatenate([
+        np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key = (int(zone),)))).random(count)
+        for zone, count in zip(zones, people_counts)
+    ]) if len(zones) > 0 else np.zeros(0)
+
+    lower, upper = np.repeat(lower, people_counts), np.repeat(upper, people_counts)
+    starts, ends = np.repeat(starts, people_counts), np.repeat(ends, people_counts)
+
+    indices = np.searchsorted(cumulative_weights, lower + uniforms * (upper - lower), side = 'right')
+    indices = np.minimum(np.maximum(indices, starts), ends - 1)
+
+    assigned_houses = np.vstack([
+        df_census['person_id'].values, df_home['residence_id'].values[indices]
+    ]).T
     return assigned_houses
 
 
@@ -30,23 +68,11 @@ def execute(context):
     df_home = context.stage("data.spatial.home")
 
     # for each zone sample enough houses for the people living in it
-    all_zones = df_census['zone_id'].unique()
-
-    #all_zones = [554782370, 554782895]
-    #al = df_census.groupby(['zone_id']).size().reset_index(name='counts')
-    #print(al.sort_values(by=['counts']))
-    
-    assigned_houses = []
-    pbar = tqdm(all_zones)
-    for zone in pbar:
-        pbar.set_description("Assigning houses in each zone")
-        df_people = df_census.loc[df_census['zone_id'] == zone]
-        df_houses = df_home.loc[df_home['zone_id'] == zone]
-        assigned_houses.append(assign_houses(df_people, df_houses, seed))
+    print("Assigning houses in each zone")
+    assigned_houses = assign_houses_grouped(df_census, df_home, seed)
     
     #create a df to merge with the census
-    census_with_home_coord = np.concatenate(assigned_houses, axis = 0)
-    df_census_home_coord = pd.DataFrame(census_with_home_coord, columns=['person_id', 'residence_id'])
+    df_census_home_coord = pd.DataFrame(assigned_houses, columns=['person_id', 'residence_id'])
     df_census_home_coord['person_id'] = df_census_home_coord['person_id'].astype(int)
     df_census_home = df_census.merge(df_census_home_coord, on='person_id')
     
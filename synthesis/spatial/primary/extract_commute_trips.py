@@ -5,6 +5,7 @@ import tqdm
 
 def configure(context):
     context.config("prague_area_code")
+    context.config("seed")
     context.stage("data.hts.clean_travel_survey")
     context.stage("synthesis.population.matched")
     context.stage("data.spatial.extract_amenities")
@@ -75,20 +76,44 @@ def extract_travel_demands(employed_trip):
         O_k[i] = len(zone)
     return O_k
    
-def extract_trip_counts(k, demand_k, pi_k, other_dests):
-    f_k = pd.DataFrame()
-
-    counts = list(np.random.multinomial(demand_k, pi_k.probability))
-    counts.extend([0]*len(other_dests))
-
-    dests = list(pi_k.commute_zone_id)
-    dests.extend(other_dests)
-    
-    f_k["destination"] = dests
-    f_k["trip_count"] = counts
-    f_k["origin"] = k
-
-    return f_k
+def extract_trip_counts(pi_kk, O_k, random):
+    """
+    Draws the outgoing trips of all home zones from their commute probabilities. The probabilities
+    form a sparse zone x zone matrix (one row segment per home zone), every multinomial is drawn as
+    conditional binomials, one vectorized draw per destination position for all zones at once.
+    Like np.random.multinomial, the last destination of a zone receives the remaining trips.
+    """
+    # Row segments per home zone in order of appearance, zones are integer indices
+    origin_codes, origins = pd.factorize(pi_kk.home_zone_id)
+    order = np.argsort(origin_codes, kind = "stable")
+    pi_kk = pi_kk.iloc[order]
+
+    offsets = np.hstack([[0], np.cumsum(np.bincount(origin_codes, minlength = len(origins)))])
+    lengths = np.diff(offsets)
+    probabilities = pi_kk.probability.values.astype(float)
+
+    remaining_trips = np.array([O_k.get(k, 0) for k in origins], dtype = np.int64)
+    remaining_probabilities = np.ones(len(origins))
+    trip_counts = np.zeros(len(pi_kk), dtype = np.int64)
+
+    for position in range(np.max(lengths) if len(lengths) > 0 else 0):
+        f = lengths > position
+        rows = offsets[:-1][f] + position
+        f_last = lengths[f] == position + 1
+
+        shares = np.clip(probabilities[rows] / np.maximum(remaining_probabilities[f], 1e-12), 0.0, 1.0)
+        shares[(remaining_probabilities[f] <= 0.0) & ~f_last] = 0.0
+        shares[f_last] = 1.0
+
+        counts = random.binomial(remaining_trips[f], shares)
+        trip_counts[rows] = counts
+
+        remaining_trips[f] -= counts
+        remaining_probabilities[f] -= probabilities[rows]
+
+    return pd.DataFrame(dict(
+        origin = pi_kk.home_zone_id.values, destination = pi_kk.commute_zone_id.values, trip_count = trip_counts
+    ))
 
 
 def execute(context):
@@ -139,30 +164,11 @@ def execute(context):
     print("Extracted primary activity travel demands for traveling census people")
     
     
-    #extract outgoing trip counts for each zone
-    f_kk_work = pd.DataFrame(columns=["origin", "destination", "trip_count"])
-    unique_zones = list(pi_kk.commute_zone_id.unique())
-
-    for k in pi_kk.home_zone_id.unique(): # too slow
-        pi_k = pi_kk[pi_kk.home_zone_id == k]
-        other_ids = [ u for u in unique_zones if not u in list(pi_k.commute_zone_id)]
-        
-        f_kk_work = f_kk_work.append(extract_trip_counts(k, O_k_work[k], pi_k, other_ids))
-
-    
-
-    f_kk_edu = pd.DataFrame(columns=["origin", "destination", "trip_count"])
-    unique_zones = list(pi_kk_edu.commute_zone_id.unique())
-
-    for k in pi_kk_edu.home_zone_id.unique(): # too slow
-        pi_k = pi_kk_edu[pi_kk_edu.home_zone_id == k]
-        other_ids = [ u for u in unique_zones if not u in list(pi_k.commute_zone_id)]
-        #print(k)
-        if(k in O_k_edu.keys()):
-            f_kk_edu = f_kk_edu.append(extract_trip_counts(k, O_k_edu[k], pi_k, other_ids))
-        else:
-            f_kk_edu = f_kk_edu.append(extract_trip_counts(k, 0, pi_k, other_ids))
+    #extract outgoing trip counts for each zone, zone pairs without commute probability have no trips
+    random = np.random.RandomState(context.config("seed"))
 
+    f_kk_work = extract_trip_counts(pi_kk, O_k_work, random)
+    f_kk_edu = extract_trip_counts(pi_kk_edu, O_k_edu, random)
 
     print("Extracted trip counts for each zone.")
 
@@ -41,6 +41,112 @@ def assign_ordering(args):
     #print(indices)
     return indices
 
+class CandidateBuckets:
+    """
+    Remaining commute candidates of a zone, grouped into spatially compact buckets of about
+    sqrt(n) candidates. A query ranks the buckets by a lower bound of |distance - beeline| and
+    only evaluates buckets which may contain a candidate at least as good as the best one found.
+    Costs and ties (smallest index) are resolved exactly like the full scan in assign_ordering.
+    """
+    def __init__(self, coordinates, bucket_size = None):
+        self.coordinates = coordinates
+        self.available = np.ones((len(coordinates),), dtype = bool)
+        self.f_nan = np.any(np.isnan(coordinates), axis = 1)
+        self.nan_count = np.count_nonzero(self.f_nan)
+
+        bucket_size = bucket_size or max(16, int(np.sqrt(len(coordinates)) / 4))
+        strip_count = max(1, int(np.ceil(np.sqrt(len(coordinates) / bucket_size))))
+
+        # Strips along x, buckets along y within each strip
+        self.members = []
+        for strip in np.array_split(np.argsort(coordinates[:, 0], kind = "stable"), strip_count):
+            strip = strip[np.argsort(coordinates[strip, 1], kind = "stable")]
+            self.members += [np.sort(bucket) for bucket in np.array_split(strip, max(1, int(np.ceil(len(strip) / bucket_size))))]
+
+        self.members = [bucket for bucket in self.members if len(bucket) > 0]
+        self.buckets = np.zeros((len(coordinates),), dtype = int)
+        for bucket, members in enumerate(self.members):
+            self.buckets[members] = bucket
+
+        self.counts = np.array([len(members) for members in self.members])
+        self.lower = np.vstack([np.nanmin(coordinates[members], axis = 0) if not np.all(self.f_nan[members]) else [np.inf, np.inf] for members in self.members])
+        self.upper = np.vstack([np.nanmax(coordinates[members], axis = 0) if not np.all(self.f_nan[members]) else [-np.inf, -np.inf] for members in self.members])
+
+    def remove(self, index):
+        if self.available[index]:
+            self.available[index] = False
+            self.counts[self.buckets[index]] -= 1
+            self.nan_count -= self.f_nan[index]
+
+    def query(self, home_coordinate, commute_distance, tolerance = 1e-6):
+        # NaN costs win the argmin in the full scan, as does index 0 if nothing is left
+        if np.isnan(commute_distance) or np.any(np.isnan(home_coordinate)):
+            return int(np.argmax(self.available)) if np.any(self.available) else 0
+
+        # The mask is only built while candidates without coordinates remain
+        if self.nan_count > 0:
+            return int(np.argmax(self.available & self.f_nan))
+
+        nearest = np.maximum(np.maximum(self.lower - home_coordinate, home_coordinate - self.upper), 0.0)
+        farthest = np.maximum(np.abs(home_coordinate - self.lower), np.abs(home_coordinate - self.upper))
+
+        bounds = np.maximum(np.maximum(
+            np.sqrt(np.sum(nearest**2, axis = 1)) - commute_distance,
+            commute_distance - np.sqrt(np.sum(farthest**2, axis = 1))), 0.0)
+        bounds[self.counts == 0] = np.inf
+
+        if np.isinf(np.min(bounds)):
+            return 0
+
+        # First the most promising buckets, then all buckets which may still hold a candidate as good as the best
+        first = np.flatnonzero(bounds <= np.min(bounds))
+        best_cost, best_index = self.evaluate(first, home_coordinate, commute_distance)
+
+        second = np.flatnonzero((bounds <= best_cost + tolerance) & (bounds > np.min(bounds)))
+
+        if len(second) > 0:
+            cost, index = self.evaluate(second, home_coordinate, commute_distance)
+
+            if cost < best_cost or (cost == best_cost and index < best_index):
+                best_cost, best_index = cost, index
+
+        return int(best_index)
+
+    def evaluate(self, buckets, home_coordinate, commute_distance):
+        members = np.concatenate([self.members[bucket] for bucket in buckets])
+        members = members[self.available[members]]
+
+        costs = np.abs(np.sqrt(np.sum((self.coordinates[members] - home_coordinate)**2, axis = 1)) - commute_distance)
+        cost = np.min(costs)
+
+        return cost, np.min(members[costs == cost])
+
+def assign_ordering_buckets(args, minimum_candidates = 4096):
+    """
+    Same assignment as assign_ordering, with the remaining candidates kept in CandidateBuckets.
+    Small zones are faster with the full scan.
+    """
+    k, df_u, V, epsg = args
+
+    if len(V) < minimum_candidates:
+        return assign_ordering(args)
+
+    candidates = CandidateBuckets(np.vstack([
+        V.commute_x.values,
+        V.commute_y.values
+    ]).T.astype(float))
+
+    indices = []
+
+    for home_coordinate, commute_distance in zip(df_u["residence_point"], df_u["beeline"]):
+        home_coordinate = np.array([home_coordinate.x, home_coordinate.y]) if hasattr(home_coordinate, "x") else np.array([np.nan, np.nan])
+
+        selected_index = candidates.query(home_coordinate, float(commute_distance))
+        indices.append(selected_index)
+        candidates.remove(selected_index)
+
+    return indices
+
 def export_shp(df, output_shp):
     travels = gpd.GeoDataFrame()
 
@@ -59,6 +165,8 @@ def configure(context):
     context.config("data_path")
     context.config("output_path")
     context.config("epsg")
+    context.config("primary_assignment_engine", "buckets") # buckets / scan, both give the same assignment
+    context.config("primary_location_processes", 1) # zones of work and education are assigned in parallel
 
     context.stage("data.spatial.home")
     context.stage("synthesis.spatial.primary.census_home")
@@ -66,12 +174,9 @@ def configure(context):
     context.stage("synthesis.spatial.primary.candidates")
 
 
-def process(context, purpose):
-    #TODO
+def prepare(context, purpose):
     df_home = context.stage("data.spatial.home")
     df_census_home = context.stage("synthesis.spatial.primary.census_home")
-    
-    epsg = context.config("epsg")
 
     #Assigning primary location (purpose): Step 1
     #Assigning primary location (purpose): Step 2
@@ -98,31 +203,62 @@ def process(context, purpose):
     df_u = df_u.merge(df_home[["residence_id","geometry"]], left_on="residence_id", right_on="residence_id", how="left")
     df_u.rename(columns = {"geometry":"residence_point"}, inplace=True)
 
-    print("Assign primary locations:")
-    df_home_zones = df_u.groupby("zone_id")
-
-    #for each home zone k assign trips from C_kk among locals
-    results = []
-    for k, df in tqdm(df_home_zones):
-        C_k =  C_kk.loc[C_kk.home_zone_id == k]
-        
-        if(df.shape[0] > C_k.shape[0]):
-            print("People in zone:",df.shape[0], k)
-            print("Travels in zone:", C_k.shape[0], C_k.home_zone_id.unique()[0])
+    # Partition people and candidates by home zone with one stable sort, the order within a zone is kept
+    df_zoned = df_u[~df_u.zone_id.isna()].sort_values(by = "zone_id", kind = "stable")
+    C_kk = C_kk.sort_values(by = "home_zone_id", kind = "stable")
+
+    zones = df_zoned.zone_id.unique()
+    person_bounds = np.searchsorted(df_zoned.zone_id.values, zones, side = "left"), np.searchsorted(df_zoned.zone_id.values, zones, side = "right")
+    candidate_bounds = np.searchsorted(C_kk.home_zone_id.values, zones, side = "left"), np.searchsorted(C_kk.home_zone_id.values, zones, side = "right")
+
+    for k, person_count, candidate_count in zip(zones, person_bounds[1] - person_bounds[0], candidate_bounds[1] - candidate_bounds[0]):
+        if(person_count > candidate_count):
+            print("People in zone:", person_count, k)
+            print("Travels in zone:", candidate_count, k)
             print("Less travels in zone than people.")
-            #return
 
+    tasks = [
+        (purpose, k, person_start, person_end, candidate_start, candidate_end)
+        for k, person_start, person_end, candidate_start, candidate_end in zip(zones, *person_bounds, *candidate_bounds)
+    ]
+
+    data = dict(
+        residence_point = df_zoned["residence_point"].values, beeline = df_zoned["beeline"].values,
+        commute_x = C_kk["commute_x"].values, commute_y = C_kk["commute_y"].values
+    )
+
+    return dict(df_u = df_u, df_zoned = df_zoned, C_kk = C_kk, tasks = tasks, data = data)
+
+def assign_zone_arrays(data, engine, epsg, task):
+    purpose, k, person_start, person_end, candidate_start, candidate_end = task
+    data = data[purpose]
+
+    df = pd.DataFrame(dict(
+        residence_point = data["residence_point"][person_start:person_end], beeline = data["beeline"][person_start:person_end]
+    ))
+
+    C_k = pd.DataFrame(dict(
+        commute_x = data["commute_x"][candidate_start:candidate_end], commute_y = data["commute_y"][candidate_start:candidate_end]
+    ))
+
+    if engine == "buckets":
+        indices = assign_ordering_buckets([k,df,C_k,epsg])
+    else:
         indices = assign_ordering([k,df,C_k,epsg])
-        ordered_candidates = C_k.iloc[indices]
-        if(df.shape[0] > ordered_candidates.shape[0]):
-            print("People in zone:",df.shape[0], k)
-            print("Assigned in zone:", ordered_candidates.shape[0], ordered_candidates.home_zone_id.unique()[0])
-            print("Less travels in zone than people.")
 
-        ordered_candidates.loc[:,"person_id"] = df["person_id"].values
-        results.append(ordered_candidates)
-      
-    C_kk_assigned = pd.concat(results)
+    return task, candidate_start + np.array(indices, dtype = int)
+
+def assign_zone(context, task):
+    result = assign_zone_arrays(context.data("zones"), context.data("engine"), context.data("epsg"), task)
+    context.progress.update()
+    return result
+
+def finish(context, purpose, prepared, selected):
+    df_u, df_zoned, C_kk = prepared["df_u"], prepared["df_zoned"], prepared["C_kk"]
+
+    C_kk_assigned = C_kk.iloc[selected].copy()
+    C_kk_assigned.loc[:,"person_id"] = df_zoned["person_id"].values
+
     df_census_assigned = df_u.merge(C_kk_assigned[["person_id","commute_point"]], left_on = "person_id", right_on="person_id", how="left")
     
     if(purpose == "work"):
@@ -141,8 +277,36 @@ def process(context, purpose):
 
 """
 def execute(context):
-    df_workers = process(context, "work")
-    df_students = process(context, "edu")
+    purposes = ["work", "edu"]
+    prepared = { purpose : prepare(context, purpose) for purpose in purposes }
+
+    # Zones of both purposes are independent, the largest ones are started first
+    tasks = [task for purpose in purposes for task in prepared[purpose]["tasks"]]
+    tasks = sorted(tasks, key = lambda task: (task[3] - task[2]) * (task[5] - task[4]), reverse = True)
+
+    data = dict(
+        zones = { purpose : prepared[purpose]["data"] for purpose in purposes },
+        engine = context.config("primary_assignment_engine"), epsg = context.config("epsg")
+    )
+
+    # Selected candidate row per person, people are sorted by zone
+    selected = { purpose : np.zeros((len(prepared[purpose]["df_zoned"]),), dtype = int) for purpose in purposes }
+
+    print("Assign primary locations:")
+    processes = context.config("primary_location_processes")
+
+    if processes > 1:
+        with context.progress(label = "Assigning primary locations in zones", total = len(tasks)):
+            with context.parallel(processes = processes, data = data) as parallel:
+                for task, indices in parallel.imap_unordered(assign_zone, tasks):
+                    selected[task[0]][task[2]:task[3]] = indices
+    else:
+        for task in tqdm(tasks):
+            task, indices = assign_zone_arrays(data["zones"], data["engine"], data["epsg"], task)
+            selected[task[0]][task[2]:task[3]] = indices
+
+    df_workers = finish(context, "work", prepared["work"], selected["work"])
+    df_students = finish(context, "edu", prepared["edu"], selected["edu"])
 
     df_workers.rename(columns={"commute_point":"workplace_point"}, inplace=True)
     df_students.rename(columns={"commute_point":"school_point"}, inplace=True)
@@ -1,12 +1,12 @@
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-import shapely.geometry as geo
+import os
 import synthesis.algo.other.misc as misc
 
-from synthesis.algo.secondary.problems import find_assignment_problems
-from synthesis.algo.secondary.rda import AssignmentSolver, DiscretizationErrorObjective, GravityChainSolver
-from synthesis.algo.secondary.components import CustomDistanceSampler, CustomDiscretizationSolver
+from synthesis.algo.secondary.problems import find_assignment_problems_columnar, make_problems, extract_coordinates
+from synthesis.algo.secondary.rda import AssignmentSolver, DiscretizationErrorObjective, GravityChainSolver, AngularTailSolver, ChainTailRelaxationSolver
+from synthesis.algo.secondary.components import CustomDistanceSampler, PooledDistanceSampler, CustomDiscretizationSolver, SharedDiscretizationSolver, build_facility_index
 
 
 
@@ -21,6 +21,17 @@ def configure(context):
     context.config("data_path")
     context.config("output_path")
     context.config("secondary_location_processes")
+    context.config("secondary_spatial_index", "sklearn") # sklearn / scipy (cKDTree)
+    context.config("secondary_index_workers", 1) # query threads per process for the scipy index
+    context.config("secondary_shared_index", False) # one memory-mapped facility index for all workers
+    context.config("secondary_batches_per_process", 20) # small batches are pulled by idle workers
+    context.config("secondary_region_size", None) # partition persons into square regions of this size (meters)
+    context.config("secondary_distance_pool_size", 0) # pre-sampled distance chains per chain template, 0 to disable
+    context.config("secondary_vectorized_sampling", False) # draw all candidate distance chains of a chain at once
+    context.config("secondary_assignment_budgets", None) # escalating passes, e.g. [[2, 50], [5, 200], [20, 1000]] (iterations, sampler iterations)
+    context.config("secondary_sample_cap", None) # average sampled distance chains per problem over all passes
+    context.config("secondary_relaxation_starts", 1) # lateral deviation starts per sampled distance chain
+    context.config("secondary_discretization_candidates", 1) # nearest facilities per point considered jointly for a chain
 
     context.stage("synthesis.spatial.primary.assigned")
     context.stage("synthesis.spatial.secondary.distance_distributions")
@@ -51,6 +62,180 @@ def print_person(person_id, df_persons, df_activities, df_trips):
     print("Trips:")
     print(df_trips[df_trips.person_id == person_id])
 
+def estimate_costs(df_trips):
+    """
+        Estimated solver cost per person (sorted by person_id): every variable
+        activity is a relaxation and discretization target.
+    """
+    person_ids, first_rows = np.unique(df_trips["person_id"].values, return_index = True)
+    f_variable = ~df_trips["following_purpose"].isin(["home", "work", "education"]).values
+
+    costs = 1.0 + np.add.reduceat(f_variable.astype(float), first_rows) if len(first_rows) > 0 else np.zeros(0)
+    return person_ids, costs
+
+def spawn_seeds(seed, count):
+    """
+        Spawns independent child seed sequences from an integer seed or a SeedSequence,
+        so no two batches share a random stream.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    return seed.spawn(count)
+
+def make_batches(df_trips, df_primary, number_of_batches, seed):
+    """
+        Splits the trips (sorted by person_id) and the primary locations into batches of similar
+        estimated cost. The boundaries are found with searchsorted, no table is filtered per batch.
+    """
+    person_ids, costs = estimate_costs(df_trips)
+    number_of_batches = max(min(number_of_batches, len(person_ids)), 1)
+
+    cumulative_costs = np.cumsum(costs)
+    targets = cumulative_costs[-1] * np.arange(1, number_of_batches) / number_of_batches if len(costs) > 0 else []
+    person_bounds = np.unique(np.hstack([[0], np.searchsorted(cumulative_costs, targets) + 1, [len(person_ids)]]).astype(int))
+
+    boundary_ids = person_ids[person_bounds[1:-1]]
+    trip_bounds = np.hstack([[0], np.searchsorted(df_trips["person_id"].values, boundary_ids), [len(df_trips)]])
+    primary_bounds = np.hstack([[0], np.searchsorted(df_primary["person_id"].values, boundary_ids), [len(df_primary)]])
+
+    random_seeds = spawn_seeds(seed, len(trip_bounds) - 1)
+
+    batches = []
+
+    for index in range(len(trip_bounds) - 1):
+        batches.append((
+            df_trips.iloc[trip_bounds[index]:trip_bounds[index + 1]],
+            df_primary.iloc[primary_bounds[index]:primary_bounds[index + 1]],
+            random_seeds[index]
+        ))
+
+    return batches
+
+def calculate_distance_buffer(distributions, quantile = 0.99):
+    """
+        Largest distance quantile over all modes and travel time bands, facilities further
+        away from the anchors of a region are rarely reached.
+    """
+    buffer = 0.0
+
+    for mode_distributions in distributions.values():
+        for distribution in mode_distributions["distributions"]:
+            index = min(np.searchsorted(distribution["cdf"], quantile), len(distribution["values"]) - 1)
+            buffer = max(buffer, distribution["values"][index])
+
+    return buffer
+
+def make_region_batches(df_trips, df_primary, destinations, region_size, buffer, number_of_batches, seed):
+    """
+        Partitions the persons into square regions by their home anchor (work or education if there
+        is no home) and splits every region into cost-balanced batches. Every batch carries the facilities
+        within the bounding box of its anchors plus the buffer. Persons of batches without any facility
+        of some purpose in their box are returned for the global pass.
+    """
+    coordinates = extract_coordinates(df_primary)
+    anchors = coordinates["home"].copy()
+
+    for purpose in ("work", "education"):
+        f = np.isnan(anchors[:, 0])
+        anchors[f] = coordinates[purpose][f]
+
+    cells = np.floor(np.nan_to_num(anchors) / region_size).astype(np.int64)
+    regions = np.unique(cells, axis = 0, return_inverse = True)[1].reshape(-1)
+    number_of_regions = np.max(regions) + 1 if len(regions) > 0 else 0
+
+    # Group persons and trips by region, the order by person_id is kept within each region
+    primary_order = np.argsort(regions, kind = "stable")
+    trip_regions = regions[np.searchsorted(df_primary["person_id"].values, df_trips["person_id"].values)]
+    trip_order = np.argsort(trip_regions, kind = "stable")
+
+    total_cost = max(np.sum(estimate_costs(df_trips)[1]), 1.0)
+
+    df_primary = df_primary.iloc[primary_order]
+    df_trips = df_trips.iloc[trip_order]
+    points = np.stack([coordinates[purpose][primary_order] for purpose in ("home", "work", "education")], axis = 1)
+
+    primary_bounds = np.searchsorted(regions[primary_order], np.arange(number_of_regions + 1))
+    trip_bounds = np.searchsorted(trip_regions[trip_order], np.arange(number_of_regions + 1))
+
+    random_seeds = spawn_seeds(seed, number_of_regions)
+
+    batches, fallback_person_ids = [], []
+
+    for region in range(number_of_regions):
+        df_region_trips = df_trips.iloc[trip_bounds[region]:trip_bounds[region + 1]]
+        df_region_primary = df_primary.iloc[primary_bounds[region]:primary_bounds[region + 1]]
+
+        region_cost = np.sum(estimate_costs(df_region_trips)[1])
+        region_batches = make_batches(df_region_trips, df_region_primary,
+            int(np.ceil(number_of_batches * region_cost / total_cost)), random_seeds[region])
+
+        position = primary_bounds[region]
+
+        for df_batch_trips, df_batch_primary, random_seed in region_batches:
+            batch_points = points[position:position + len(df_batch_primary)].reshape(-1, 2)
+            position += len(df_batch_primary)
+
+            if len(df_batch_trips) == 0:
+                continue
+
+            lower = np.nanmin(batch_points, axis = 0) - buffer
+            upper = np.nanmax(batch_points, axis = 0) + buffer
+
+            batch_destinations = {}
+
+            for purpose, data in destinations.items():
+                f = np.all((data["locations"] >= lower) & (data["locations"] <= upper), axis = 1)
+                batch_destinations[purpose] = dict(locations = data["locations"][f], identifiers = data["identifiers"][f])
+
+            if any(len(data["identifiers"]) == 0 for data in batch_destinations.values()):
+                fallback_person_ids.append(df_batch_trips["person_id"].unique())
+                continue
+
+            batches.append((df_batch_trips, df_batch_primary, random_seed, dict(
+                destinations = batch_destinations, lower = lower, upper = upper
+            )))
+
+    fallback_person_ids = np.concatenate(fallback_person_ids) if len(fallback_person_ids) > 0 else np.zeros(0, dtype = int)
+    return batches, fallback_person_ids
+
+def find_fallback_problems(relaxed_locations, radii, offsets, region):
+    """
+        A discretized location is only guaranteed to be the nearest facility (or, with joint candidates,
+        the candidates the nearest facilities) if the circle of the given radius around the relaxed location
+        lies within the box of the region's facilities. The radius is the distance to the selected facility,
+        or to the farthest candidate when candidates are chosen jointly.
+    """
+    margins = np.minimum(relaxed_locations - region["lower"], region["upper"] - relaxed_locations).min(axis = 1)
+
+    return np.maximum.reduceat(radii > margins, offsets[:-1]) if len(offsets) > 1 else np.zeros(0, dtype = bool)
+
+def run_batches(context, batches, processes, data, label):
+    with context.progress(label = label, total = sum(batch[0]["person_id"].nunique() for batch in batches)):
+        with context.parallel(processes = processes, data = data) as parallel:
+            df_locations, df_convergence, fallback_person_ids = [], [], []
+
+            for df_locations_item, df_convergence_item, fallback_item in parallel.imap_unordered(process, batches):
+                df_locations.append(df_locations_item)
+                df_convergence.append(df_convergence_item)
+                fallback_person_ids.append(fallback_item)
+
+    return df_locations, df_convergence, fallback_person_ids
+
+def make_convergence_report(df_convergence, by):
+    """
+        Success rate, mean iteration counts and objective and total time per phase of the problems grouped by the given column.
+    """
+    df_report = df_convergence.groupby(by).agg(
+        count = ("valid", "size"), valid = ("valid", "mean"), objective = ("objective", "mean"),
+        iterations = ("iterations", "mean"), sampler_iterations = ("sampler_iterations", "mean"),
+        relaxation_iterations = ("relaxation_iterations", "mean"),
+        sampling_time = ("sampling_time", "sum"), relaxation_time = ("relaxation_time", "sum"),
+        discretization_time = ("discretization_time", "sum")
+    )
+
+    return df_report
+
 def remove_ids(remove_ids, df_persons, df_activities, df_trips):
     df_persons = df_persons[~df_persons.person_id.isin(remove_ids)]
     df_activities = df_activities[~df_activities.person_id.isin(remove_ids)]
@@ -79,48 +264,88 @@ def execute(context):
     print("Processing persons:", number_of_persons)
     number_w_secondary = len(set(df_activities[df_activities.purpose.isin(["leisure","shop","other"])].person_id.values))
     print("Persons with secondary destinations:", number_w_secondary, number_w_secondary/number_of_persons, "%")
-    unique_person_ids = np.array_split(unique_person_ids, processes)
 
-    random = np.random.RandomState(context.config("seed"))
-    random_seeds = random.randint(10000, size = processes)
+    # Build the facility index once, workers memory-map it instead of building their own
+    facility_index_path = None
 
-    # Create batch problems for parallelization
-    batches = []
+    if context.config("secondary_shared_index"):
+        facility_index_path = build_facility_index(destinations, os.path.join(context.path(), "facility_index"))
 
-    for index in range(processes):
-        batches.append((
-            df_trips[df_trips["person_id"].isin(unique_person_ids[index])],
-            df_primary[df_primary["person_id"].isin(unique_person_ids[index])],
-            random_seeds[index]
-        ))
+    global_data = dict(
+        distance_distributions = distance_distributions,
+        destinations = None if context.config("secondary_shared_index") else destinations,
+        facility_index_path = facility_index_path
+    )
+
+    number_of_batches = processes * context.config("secondary_batches_per_process")
+    region_size = context.config("secondary_region_size")
+    batch_seed, fallback_seed = spawn_seeds(context.config("seed"), 2)
+
+    if region_size is None:
+        # Cut the sorted persons into many small batches of similar estimated cost
+        batches = [batch + (None,) for batch in make_batches(df_trips, df_primary, number_of_batches, batch_seed)]
+        fallback_person_ids = [np.zeros(0, dtype = int)]
+    else:
+        # Every batch only sees the facilities around the anchors of its region
+        buffer = calculate_distance_buffer(distance_distributions)
+        print("Region size: %.0f, facility buffer: %.0f" % (region_size, buffer))
+
+        batches, fallback_person_ids = make_region_batches(
+            df_trips, df_primary, destinations, region_size, buffer, number_of_batches, batch_seed)
+        fallback_person_ids = [fallback_person_ids]
+
+    print("Batches:", len(batches))
 
     # Run algorithm in parallel
-    with context.progress(label = "Assigning secondary locations to persons", total = number_of_persons):
-        with context.parallel(processes = processes, data = dict(
-            distance_distributions = distance_distributions,
-            destinations = destinations
-        )) as parallel:
-            df_locations, df_convergence = [], []
-
-            for df_locations_item, df_convergence_item in parallel.imap_unordered(process, batches):
-                df_locations.append(df_locations_item)
-                df_convergence.append(df_convergence_item)
+    df_locations, df_convergence, fallback_items = run_batches(context, batches, processes,
+        data = dict(global_data, destinations = None) if region_size is not None else global_data,
+        label = "Assigning secondary locations to persons")
+
+    fallback_person_ids = np.unique(np.concatenate(fallback_person_ids + fallback_items))
+
+    # Persons whose chains leave the facilities of their region are assigned again with all facilities
+    if len(fallback_person_ids) > 0:
+        print("Persons in global pass:", len(fallback_person_ids))
+
+        df_locations = [df[~df["person_id"].isin(fallback_person_ids)] for df in df_locations]
+        df_convergence = [df[~df["person_id"].isin(fallback_person_ids)] for df in df_convergence]
+
+        df_fallback_trips = df_trips[df_trips["person_id"].isin(fallback_person_ids)]
+        df_fallback_primary = df_primary[df_primary["person_id"].isin(fallback_person_ids)]
+
+        fallback_batches = [batch + (None,) for batch in make_batches(
+            df_fallback_trips, df_fallback_primary, number_of_batches, fallback_seed)]
+
+        df_fallback_locations, df_fallback_convergence, _ = run_batches(context, fallback_batches, processes,
+            data = global_data, label = "Assigning secondary locations in global pass")
+
+        df_locations += df_fallback_locations
+        df_convergence += df_fallback_convergence
 
     df_locations = pd.concat(df_locations).sort_values(by = ["person_id", "trip_index"])
     print("Locations:", df_locations.shape)
     df_convergence = pd.concat(df_convergence)
 
     print("Success rate:", df_convergence["valid"].mean())
+    print("Success rate by budget pass:")
+    print(df_convergence.groupby(["budget", "budget_iterations", "budget_sampler_iterations"])["valid"].agg(["count", "mean"]))
+
+    for by in ("size", "mode"):
+        df_report = make_convergence_report(df_convergence, by)
+        print("Convergence by %s:" % by)
+        print(df_report)
+
+        df_report.to_csv(context.config("output_path") + "/csv/secondary_convergence_by_%s.csv" % by)
 
     return df_locations, df_convergence
     
 
     
 def process(context, arguments):
-  df_trips, df_primary, random_seed = arguments
+  df_trips, df_primary, random_seed, region = arguments
 
-  # Set up RNG
-  random = np.random.RandomState(context.config("seed"))
+  # Set up RNG, every batch has its own seed
+  random = np.random.RandomState(np.random.MT19937(random_seed))
 
   # Set up distance sampler
   distance_distributions = context.data("distance_distributions")
@@ -128,24 +353,30 @@ def process(context, arguments):
   distance_sampler = CustomDistanceSampler(
         maximum_iterations = 100,#1000
         random = random,
-        distributions = distance_distributions)
+        distributions = distance_distributions,
+        vectorized = context.config("secondary_vectorized_sampling"))
+
+  # Share pre-sampled distance chains between problems with the same template
+  if context.config("secondary_distance_pool_size") > 0:
+    distance_sampler = PooledDistanceSampler(distance_sampler,
+      random = random, pool_size = context.config("secondary_distance_pool_size"))
 
-  # Set up relaxation solver; currently, we do not consider tail problems.
+  # Set up relaxation solver; chains are relaxed by gravity, tails by random angles
   gamma = 20.0
   delta_p = 0.1
 
-  relaxation_solver = GravityChainSolver(
-    random = random, eps = 20.0, lateral_deviation = 20.0, alpha = 0.3
+  chain_solver = GravityChainSolver(
+    random = random, eps = 20.0, lateral_deviation = 20.0, alpha = 0.3,
+    starts = context.config("secondary_relaxation_starts")
     #lateral deviation in meters (sigma)
     # displacemenet factor delta_p 0.1 (?)
     #convergence threshold in meters
     )
 
-    #lateral deviation 10
-  # Set up discretization solver
-  destinations = context.data("destinations")
-  discretization_solver = CustomDiscretizationSolver(destinations)
+  tail_solver = AngularTailSolver(random = random)
+  relaxation_solver = ChainTailRelaxationSolver(chain_solver, tail_solver)
 
+    #lateral deviation 10
   # Maximum discretization errors
 
   #thresholds = dict(
@@ -158,41 +389,107 @@ def process(context, arguments):
     bike = 1000.0, walk = 750.0
   )
 
+  # Set up discretization solver, optionally choosing among the nearest candidates of each point jointly
+  candidates = context.config("secondary_discretization_candidates")
+
+  if region is not None:
+    discretization_solver = CustomDiscretizationSolver(region["destinations"],
+      index = context.config("secondary_spatial_index"), workers = context.config("secondary_index_workers"),
+      candidates = candidates, thresholds = thresholds)
+  elif context.data("facility_index_path") is None:
+    destinations = context.data("destinations")
+    discretization_solver = CustomDiscretizationSolver(destinations,
+      index = context.config("secondary_spatial_index"), workers = context.config("secondary_index_workers"),
+      candidates = candidates, thresholds = thresholds)
+  else:
+    discretization_solver = SharedDiscretizationSolver(context.data("facility_index_path"),
+      candidates = candidates, thresholds = thresholds)
+
   assignment_objective = DiscretizationErrorObjective(thresholds = thresholds)
   assignment_solver = AssignmentSolver(
       distance_sampler = distance_sampler,
       relaxation_solver = relaxation_solver,
       discretization_solver = discretization_solver,
       objective = assignment_objective,
-      maximum_iterations = 20 #20
+      maximum_iterations = 20, #20
+      budgets = context.config("secondary_assignment_budgets")
       )
 
-  df_locations = []
-  df_convergence = []
-
-  last_person_id = None
-
-  for problem in find_assignment_problems(df_trips, df_primary):    
-      result = assignment_solver.solve(problem)
+  columns = find_assignment_problems_columnar(df_trips, df_primary)
+  problems = make_problems(columns)
+
+  if context.config("secondary_sample_cap") is not None:
+    assignment_solver.maximum_samples = context.config("secondary_sample_cap") * len(problems)
+
+  results = assignment_solver.solve_batch(problems)
+
+  # Write results into preallocated arrays
+  sizes = columns["size"]
+  offsets = columns["purpose_offsets"]
+
+  person_ids = np.repeat(columns["person_id"], sizes)
+  trip_indices = np.repeat(columns["trip_index"], sizes) + np.arange(offsets[-1]) - np.repeat(offsets[:-1], sizes)
+  destination_ids = np.empty(offsets[-1], dtype = object)
+  locations = np.zeros((offsets[-1], 2))
+  relaxed_locations = np.zeros((offsets[-1], 2))
+  radii = np.full(offsets[-1], np.nan)
+  valid = np.zeros(len(problems), dtype = bool)
+  budgets = np.zeros(len(problems), dtype = int)
+  budget_limits = np.zeros((len(problems), 2), dtype = int)
+  iterations = np.zeros(len(problems), dtype = int)
+  sampler_iterations = np.zeros(len(problems), dtype = int)
+  relaxation_iterations = np.zeros(len(problems), dtype = int)
+  objectives = np.zeros(len(problems))
+  timings = np.zeros((len(problems), 3))
+
+  for index, result in enumerate(results):
       #pprint.pprint(result)
-
-      starting_trip_index = problem["trip_index"]
-
-      for index, (identifier, location) in enumerate(zip(result["discretization"]["identifiers"], result["discretization"]["locations"])):
-          df_locations.append((
-              problem["person_id"], starting_trip_index + index, identifier, geo.Point(location)
-          ))
-
-      df_convergence.append((
-          result["valid"], problem["size"]
-      ))
-
-      if problem["person_id"] != last_person_id:
-          last_person_id = problem["person_id"]
-          context.progress.update()
-
-  df_locations = pd.DataFrame.from_records(df_locations, columns = ["person_id", "trip_index", "destination_id", "geometry"])
-  df_locations = gpd.GeoDataFrame(df_locations, crs = "EPSG:5514")
-
-  df_convergence = pd.DataFrame.from_records(df_convergence, columns = ["valid", "size"])
-  return df_locations, df_convergence
\ No newline at end of file
+      destination_ids[offsets[index]:offsets[index + 1]] = result["discretization"]["identifiers"]
+      locations[offsets[index]:offsets[index + 1]] = result["discretization"]["locations"]
+      relaxed_locations[offsets[index]:offsets[index + 1]] = result["relaxation"]["locations"]
+      valid[index] = result["valid"]
+      budgets[index] = result["budget"]
+      budget_limits[index] = [result["budget_iterations"], -1 if result["budget_sampler_iterations"] is None else result["budget_sampler_iterations"]]
+      iterations[index] = result["iterations"]
+      objectives[index] = result["objective"]
+      timings[index] = [result["timings"]["sampling"], result["timings"]["relaxation"], result["timings"]["discretization"]]
+
+      # Tails and shortcuts do not iterate
+      sampler_iterations[index] = -1 if result["distance"]["iterations"] is None else result["distance"]["iterations"]
+      relaxation_iterations[index] = -1 if result["relaxation"]["iterations"] is None else result["relaxation"]["iterations"]
+
+      # Joint candidate selection reports the distances to the farthest candidates
+      if "radii" in result["discretization"]:
+          radii[offsets[index]:offsets[index + 1]] = result["discretization"]["radii"]
+
+  # Main mode of each problem is the mode of its longest trip
+  trip_counts = np.diff(columns["trip_offsets"])
+  trip_order = np.lexsort((-np.nan_to_num(columns["travel_times"].astype(float), nan = -1.0), np.repeat(np.arange(len(problems)), trip_counts)))
+  modes = columns["modes"][trip_order[columns["trip_offsets"][:-1]]]
+
+  # Persons with a location that may have a closer facility outside of the region go to the global pass
+  fallback_person_ids = np.zeros(0, dtype = columns["person_id"].dtype)
+
+  if region is not None:
+      # Otherwise the circle passes through the selected facility
+      f = np.isnan(radii)
+      radii[f] = np.sqrt(np.sum((locations[f] - relaxed_locations[f])**2, axis = 1))
+
+      fallback = find_fallback_problems(relaxed_locations, radii, offsets, region)
+      fallback_person_ids = np.unique(columns["person_id"][fallback])
+
+  for k in range(len(np.unique(columns["person_id"]))):
+      context.progress.update()
+
+  df_locations = pd.DataFrame(dict(
+      person_id = person_ids, trip_index = trip_indices, destination_id = destination_ids
+  )).infer_objects()
+  df_locations = gpd.GeoDataFrame(df_locations, geometry = gpd.points_from_xy(locations[:, 0], locations[:, 1]), crs = "EPSG:5514")
+
+  df_convergence = pd.DataFrame(dict(
+      person_id = columns["person_id"], valid = valid, size = sizes, mode = modes, budget = budgets,
+      budget_iterations = budget_limits[:, 0], budget_sampler_iterations = budget_limits[:, 1],
+      iterations = iterations, sampler_iterations = sampler_iterations, relaxation_iterations = relaxation_iterations,
+      objective = objectives, sampling_time = timings[:, 0], relaxation_time = timings[:, 1], discretization_time = timings[:, 2]
+  ))
+  return df_locations, df_convergence, fallback_person_ids
@@ -0,0 +1,36 @@
+import numpy as np
+
+from synthesis.algo.secondary.rda import AssignmentSolver
+
+class Sampler:
+    def __init__(self):
+        self.maximum_iterations = 100
+        self.used_iterations = []
+
+    def sample_batch(self, problems):
+        self.used_iterations.append(self.maximum_iterations)
+        return [dict(distances = np.zeros(1)) for problem in problems]
+
+class Relaxation:
+    def solve_batch(self, problems, distances):
+        return [dict(locations = np.zeros((1, 2))) for problem in problems]
+
+class Discretization:
+    def solve_batch(self, problems, locations, distances = None):
+        return [dict(locations = problem_locations) for problem_locations in locations]
+
+class Objective:
+    def evaluate(self, problem, distance_result, relaxation_result, discretization_result):
+        # Only the second problem is ever solved
+        return dict(valid = problem == "valid", objective = 0.0)
+
+def test_budgets_restore_sampler_iterations():
+    sampler = Sampler()
+    solver = AssignmentSolver(sampler, Relaxation(), Discretization(), Objective(), budgets = [(1, 20), (2, None), (1, 500)])
+
+    results = solver.solve_batch(["invalid", "valid"])
+
+    assert sampler.used_iterations == [20, 20, 20, 500]
+    assert sampler.maximum_iterations == 100
+
+    assert [(result["budget"], result["budget_iterations"], result["budget_sampler_iterations"]) for result in results] == [(2, 1, 500), (0, 1, 20)]
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point
+
+import synthesis.spatial.secondary.assigned as assigned
+from synthesis.algo.secondary.problems import FIELDS, LOCATION_FIELDS, find_assignment_problems, find_assignment_problems_columnar
+
+class Progress:
+    def update(self, count = 1):
+        pass
+
+class Context:
+    def __init__(self, config, data):
+        self._config = config
+        self._data = data
+        self.progress = Progress()
+
+    def config(self, name, default = None):
+        return self._config.get(name, default)
+
+    def data(self, name):
+        return self._data[name]
+
+def make_context():
+    distributions = {}
+
+    for mode in ("car", "ride", "pt", "bike", "walk"):
+        distributions[mode] = dict(bounds = np.array([np.inf]), distributions = [
+            dict(values = np.linspace(100.0, 2000.0, 20), cdf = np.linspace(0.05, 1.0, 20), weights = np.ones(20))
+        ])
+
+    # Facilities of every purpose are identified by their purpose, so misplaced activities are visible
+    destinations = {
+        purpose: dict(locations = np.array([[0.0, 0.0], [5000.0, 5000.0]]) + offset, identifiers = np.array([purpose] * 2, dtype = object))
+        for offset, purpose in enumerate(("shop", "leisure", "other"))
+    }
+
+    return Context(dict(
+        secondary_distance_pool_size = 0, secondary_vectorized_sampling = False, secondary_relaxation_starts = 1, secondary_discretization_candidates = 1,
+        secondary_spatial_index = "sklearn", secondary_index_workers = 1,
+        secondary_assignment_budgets = None, secondary_sample_cap = None
+    ), dict(distance_distributions = distributions, destinations = destinations, facility_index_path = None))
+
+def make_trips(chains):
+    rows = []
+
+    for person_id, purposes in chains:
+        for trip_id in range(len(purposes) - 1):
+            rows.append((person_id, trip_id, purposes[trip_id], purposes[trip_id + 1], "car", 600.0))
+
+    return pd.DataFrame(rows, columns = FIELDS)
+
+def make_primary(person_ids):
+    return pd.DataFrame([
+        (person_id, Point(1000.0, 1000.0), Point(3000.0, 1000.0), Point(1000.0, 3000.0)) for person_id in person_ids
+    ], columns = LOCATION_FIELDS)
+
+def test_activity_orders_of_tails():
+    chains = [
+        (1, ["shop", "leisure", "home"]), # start of day tail
+        (2, ["home", "shop", "leisure"]), # end of day tail
+        (3, ["home", "other", "work", "shop", "home"]) # chains
+    ]
+
+    df_trips, df_primary = make_trips(chains), make_primary([1, 2, 3])
+    df_locations, _, _ = assigned.process(make_context(), (df_trips, df_primary, np.random.SeedSequence(0), None))
+
+    # The output stage places the location of trip_index at activity_order trip_index + 1
+    assigned_purposes = {
+        (person_id, trip_index + 1): purpose
+        for person_id, trip_index, purpose in df_locations[["person_id", "trip_index", "destination_id"]].itertuples(index = False)
+    }
+
+    expected_purposes = {
+        (person_id, order): purpose
+        for person_id, purposes in chains for order, purpose in enumerate(purposes)
+        if purpose not in ("home", "work", "education")
+    }
+
+    assert assigned_purposes == expected_purposes
+
+def test_columnar_problems_match_generator():
+    df_trips = make_trips([
+        (1, ["shop", "leisure", "home", "other", "home"]),
+        (2, ["home", "shop", "leisure"]),
+        (3, ["work", "home"])
+    ])
+    df_primary = make_primary([1, 2, 3])
+
+    problems = list(find_assignment_problems(df_trips, df_primary))
+    columns = find_assignment_problems_columnar(df_trips, df_primary)
+
+    assert [problem["trip_index"] for problem in problems] == list(columns["trip_index"]) == [-1, 2, 0]